@@ -3,6 +3,7 @@
 
 # Uses 'python 3.x'
 # Dependencies 'sys' 'cv2' 'numpy' 'argparse'
+# Batch mode : '-in' may be a directory, a glob or a video ('-out' is then a directory, or a video)
 
 # Rajbir Malik
 # 2017CS10416
@@ -11,6 +12,11 @@ import numpy as np
 import cv2 as cv
 import argparse
 import sys
+import os
+import glob
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Function for command line arguments
@@ -22,19 +28,181 @@ def set_parser():
     parser.add_argument('-in', action="store", dest="_in", default=None, type=str, help='Input-file relative path.')
     # Adding -out
     parser.add_argument('-out', action="store", dest="_out", default=None, type=str, help='Output-file relative path.')
+    # Adding -workers
+    parser.add_argument('-workers', action="store", dest="_workers", default=os.cpu_count(), type=int, help='Worker threads (batch mode).')
     return parser
 
 
+# Sum along an axis (kept), in a wide accumulator (without promoting the image)
+def reduce_sum(img, _axis):
+    # OpenCV reduces straight into doubles
+    if img.dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64) and img.ndim in (2, 3) and _axis in (0, 1):
+        return cv.reduce(img, _axis, cv.REDUCE_SUM, dtype=cv.CV_64F).reshape(
+            img.shape[:_axis] + (1,) + img.shape[_axis+1:])
+    _acc = np.float64 if np.issubdtype(img.dtype, np.floating) else np.uint64
+    return np.add.reduce(img, axis=_axis, dtype=_acc, keepdims=True)
+
+
+# Averages over blocks of (bh, bw) pixels (the last ones may be smaller)
+def block_average(img, _block):
+    _bh, _bw = _block
+    _h, _w = img.shape[:2]
+    _acc = np.float64 if np.issubdtype(img.dtype, np.floating) else np.uint64
+    # Block sums
+    _r, _c = np.arange(0, _h, _bh), np.arange(0, _w, _bw)
+    _sum = np.add.reduceat(np.add.reduceat(img, _r, axis=0, dtype=_acc), _c, axis=1, dtype=_acc)
+    # Block sizes
+    _nr, _nc = np.diff(np.append(_r, _h)), np.diff(np.append(_c, _w))
+    _cnt = np.outer(_nr, _nc).reshape(_sum.shape[:2] + (1,)*(img.ndim-2))
+    # Expanding back
+    return np.repeat(np.repeat(_sum/_cnt, _nr, axis=0), _nc, axis=1)
+
+
 # Processing Function
-def process(img):
-    img = np.array(img, dtype=np.uint64)
-    # Slow, single line solution
-    new_img = []
-    row_len = img.shape[1]
-    for row in img:
-        avg = row.sum(axis=0)/row_len
-        new_img.append([avg]*row_len)
-    return np.array(new_img)
+# Averages the rows (_axis=1), the columns (_axis=0) or blocks (_block=(bh, bw))
+# Row/Column means are broadcast back as a (read-only) view, without copies
+def process(img, _axis=1, _block=None):
+    if _block is not None:
+        return block_average(img, _block)
+    _mean = reduce_sum(img, _axis)/img.shape[_axis]
+    return np.broadcast_to(_mean, img.shape)
+
+
+# Streaming version of process, for very tall images (e.g. memory mapped)
+# Yields (r0, r1, processed rows [r0, r1)), chunks of about _chunk rows
+# (a multiple of the block height, for blocks), column means take a first pass
+def process_stream(img, _chunk=1024, _axis=1, _block=None):
+    _h = img.shape[0]
+    if _block is not None:
+        _chunk = max(_chunk//_block[0], 1)*_block[0]
+    # Column sums over all chunks
+    if _block is None and _axis == 0:
+        _sum = 0
+        for _r0 in range(0, _h, _chunk):
+            _sum = _sum + reduce_sum(np.asarray(img[_r0:_r0+_chunk]), 0)
+        _mean = _sum/_h
+    for _r0 in range(0, _h, _chunk):
+        _r1 = min(_r0+_chunk, _h)
+        if _block is None and _axis == 0:
+            yield _r0, _r1, np.broadcast_to(_mean, (_r1-_r0,) + img.shape[1:])
+        else:
+            yield _r0, _r1, process(np.asarray(img[_r0:_r1]), _axis, _block)
+
+
+# Extensions taken as videos, and as images (in directories)
+_videos = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.webm')
+_images = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+# Whether the input is a batch (directory, glob or video)
+def is_batch(_in):
+    return os.path.isdir(_in) or glob.has_magic(_in) or _in.lower().endswith(_videos)
+
+
+# Frame as an 8-bit image
+def to_uint8(img):
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+# Batch over image files, every worker decodes, processes and encodes its own files
+# (OpenCV releases the GIL, so the stages of different files overlap)
+# Returns (written, skipped)
+def batch_images(_files, _out, _workers):
+    os.makedirs(_out, exist_ok=True)
+    # One file
+    def _job(_f):
+        img = cv.imread(_f)
+        if img is None:
+            raise ValueError('Could not read ' + _f)
+        if not cv.imwrite(os.path.join(_out, os.path.basename(_f)), to_uint8(process(img))):
+            raise IOError('Could not write ' + _f)
+    _done, _bad = 0, 0
+    with ThreadPoolExecutor(_workers) as pool:
+        for _f, _fut in [(_f, pool.submit(_job, _f)) for _f in _files]:
+            try:
+                _fut.result()
+                _done += 1
+            except Exception as _e:
+                print('Skipped ' + _f + ' : ' + str(_e))
+                _bad += 1
+    return _done, _bad
+
+
+# Batch over the frames of a video, three stages overlapping: decoding (in order, on
+# the calling thread), processing (in the pool) and encoding (on its own thread, in
+# the original order). A frame that fails to decode is logged and skipped.
+# Returns (written, skipped)
+def batch_video(_in, _out, _workers, _retries=16):
+    cap = cv.VideoCapture(_in)
+    if not cap.isOpened():
+        raise ValueError('Could not open ' + _in)
+    fps = cap.get(cv.CAP_PROP_FPS) or 25
+    count = int(cap.get(cv.CAP_PROP_FRAME_COUNT) or 0)
+    fourcc = cv.VideoWriter_fourcc(*('XVID' if _out.lower().endswith('.avi') else 'mp4v'))
+    writer = None
+    pending = deque()
+    _done, _bad = 0, 0
+    # Encoding a frame (encoder thread only)
+    def _encode(_i, _fut):
+        nonlocal writer, _done, _bad
+        try:
+            img = to_uint8(_fut.result())
+            if writer is None:
+                writer = cv.VideoWriter(_out, fourcc, fps, (img.shape[1], img.shape[0]))
+            writer.write(img)
+            _done += 1
+        except Exception as _e:
+            print('Skipped frame ' + str(_i) + ' : ' + str(_e))
+            _bad += 1
+    # Frames that could not be decoded
+    _lost = 0
+    def _skip(_i, _why):
+        nonlocal _lost
+        print('Skipped frame ' + str(_i) + ' : ' + _why)
+        _lost += 1
+    with ThreadPoolExecutor(_workers) as pool, ThreadPoolExecutor(1) as encoder:
+        _i, _fails = 0, 0
+        while True:
+            # End of stream, unless frames are known to remain (a bad packet)
+            if not cap.grab():
+                if _i < count and _fails < _retries:
+                    _skip(_i, 'could not be read')
+                    _i += 1
+                    _fails += 1
+                    continue
+                if _i < count:
+                    print('Stream ended at frame %d of %d' % (_i, count))
+                break
+            _fails = 0
+            ok, img = cap.retrieve()
+            if not ok or img is None:
+                _skip(_i, 'could not be decoded')
+                _i += 1
+                continue
+            pending.append(encoder.submit(_encode, _i, pool.submit(process, img)))
+            _i += 1
+            # Bounded number of frames in flight
+            if len(pending) >= 2*_workers:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    cap.release()
+    if writer is not None:
+        writer.release()
+    return _done, _bad+_lost
+
+
+# Batch mode, reports the frames per second
+def batch(_in, _out, _workers):
+    _t = time.perf_counter()
+    if _in.lower().endswith(_videos):
+        _done, _bad = batch_video(_in, _out or './final.mp4', _workers)
+    else:
+        _pat = os.path.join(_in, '*') if os.path.isdir(_in) else _in
+        _files = sorted(_f for _f in glob.glob(_pat) if _f.lower().endswith(_images))
+        _done, _bad = batch_images(_files, _out or './final', _workers)
+    _t = time.perf_counter()-_t
+    print('%d frames written, %d skipped, %.1f frames/s' % (_done, _bad, _done/max(_t, 1e-9)))
 
 
 # Main
@@ -49,6 +217,11 @@ if __name__ == '__main__':
         # Parsing
         parse = parser.parse_args(sys.argv[1:])
 
+        # Batch
+        if parse._in and is_batch(parse._in):
+            batch(parse._in, parse._out, parse._workers)
+            sys.exit(0)
+
         # Reading
         if parse._in:
             img = cv.imread(parse._in)
@@ -0,0 +1,155 @@
+# Benchmark of the tone mapping operators over the bundled HDR images
+# For every (image, operator) run, records the wall time (best of the repeats), the
+# number of 2D FFTs (planes transformed), the peak traced memory and a checksum of
+# the 8-bit output. Results are written as JSON and can be compared to a stored
+# baseline, checksums must match (the outputs did not change).
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import rescaling
+import reinhard
+
+# Bundled images
+_dir = os.path.dirname(os.path.abspath(__file__))
+_images = [os.path.join(_dir, _n) for _n in ['memorial.hdr', 'nave.hdr', 'rosette.hdr']]
+
+# Counter of the 2D transforms
+_ffts = [0]
+
+
+# Wrapping the numpy (and scipy) 2D transforms with a counter
+def count_ffts():
+    def _counted(_fn):
+        def _wrap(a, *args, **kwargs):
+            _ffts[0] += int(np.prod(np.shape(a)[:-2], dtype=np.int64))
+            return _fn(a, *args, **kwargs)
+        return _wrap
+    _mods = [np.fft]
+    try:
+        import scipy.fft
+        _mods.append(scipy.fft)
+    except ImportError:
+        pass
+    for _mod in _mods:
+        for _name in ['fft2', 'ifft2', 'rfft2', 'irfft2', 'fftn', 'ifftn', 'rfftn', 'irfftn']:
+            setattr(_mod, _name, _counted(getattr(_mod, _name)))
+
+
+# Checksum of an output, as written (8-bit)
+def checksum(_img: np.ndarray) -> str:
+    return hashlib.sha256(np.clip(np.round(_img), 0, 255).astype(np.uint8).tobytes()).hexdigest()
+
+
+# Reinhard sweep (best_only=False), checksum of the written frames
+def _sweep(_img):
+    _cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as _tmp:
+        os.chdir(_tmp)
+        try:
+            os.mkdir('imgs')
+            reinhard.reinhard_map(_img)
+            plt.close('all')
+            _h = hashlib.sha256()
+            for _n in sorted(glob.glob('imgs/*.jpg')):
+                with open(_n, 'rb') as _f:
+                    _h.update(_f.read())
+            return _h.hexdigest()
+        finally:
+            os.chdir(_cwd)
+
+
+# Operators, name -> function of the gamma corrected (_g) and the raw (_img) image
+_cases = {
+    'scale_255': lambda _g, _img: rescaling.scale(_g, 255, 0),
+    'scale_4000': lambda _g, _img: rescaling.scale(_g, 4000, 0),
+    'scale_10000': lambda _g, _img: rescaling.scale(_g, 10000, 0),
+    'log_lum_3': lambda _g, _img: rescaling.log_lum(_g, base=3, bmn=1, bmx=6, al=0.8),
+    'log_lum_10': lambda _g, _img: rescaling.log_lum(_g, base=10, bmn=0.1, bmx=2.1, al=0.8),
+    'reinhard_best': lambda _g, _img: reinhard.reinhard_map(_img, True),
+    'reinhard_local': lambda _g, _img: reinhard.reinhard_local(_img),
+    'reinhard_sweep': lambda _g, _img: _sweep(_img),
+}
+
+
+# Running a case, returns its record
+# Repeats are timed untraced (best is kept), peak memory comes from one more, traced, run
+def run(_fn, _g, _img, _repeat: int = 3) -> dict:
+    _best = np.inf
+    for _ in range(_repeat):
+        _ffts[0] = 0
+        _t = time.perf_counter()
+        _out = _fn(_g, _img)
+        _best = min(_best, time.perf_counter()-_t)
+    _n = _ffts[0]
+    tracemalloc.start()
+    _fn(_g, _img)
+    _peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'time': _best,
+        'ffts': _n,
+        'peak': _peak,
+        'checksum': _out if isinstance(_out, str) else checksum(_out),
+    }
+
+
+# Comparing results with a baseline, returns whether all outputs match
+def compare(_res: dict, _base: dict) -> bool:
+    _ok = True
+    for _img, _runs in _res.items():
+        for _case, _r in _runs.items():
+            _b = _base.get(_img, {}).get(_case)
+            if _b is None:
+                print('%-14s %-16s (not in baseline)' % (_img, _case))
+                continue
+            _same = _r['checksum'] == _b['checksum']
+            _ok = _ok and _same
+            print('%-14s %-16s time x%.2f  ffts %d -> %d  peak x%.2f  %s' % (
+                _img, _case, _b['time']/_r['time'], _b['ffts'], _r['ffts'],
+                _b['peak']/max(_r['peak'], 1), 'same' if _same else 'CHANGED'))
+    return _ok
+
+
+# Command line arguments
+def set_parser():
+    parser = argparse.ArgumentParser(description='Tone mapping benchmark')
+    parser.add_argument('images', nargs='*', default=_images, help='HDR images (default, the bundled ones).')
+    parser.add_argument('-cases', nargs='+', default=list(_cases), choices=list(_cases), help='Operators to run.')
+    parser.add_argument('-repeat', type=int, default=3, help='Runs per case (best time is kept).')
+    parser.add_argument('-out', default='benchmark.json', help='Results (JSON).')
+    parser.add_argument('-baseline', default=None, help='Baseline results (JSON) to compare with.')
+    return parser
+
+
+# Main
+if __name__ == '__main__':
+    parse = set_parser().parse_args(sys.argv[1:])
+    count_ffts()
+    results = {}
+    for _name in parse.images:
+        _img = rescaling.read(_name)
+        _g = rescaling.gamma_crr(_img)
+        _key = os.path.basename(_name)
+        results[_key] = {}
+        for _case in parse.cases:
+            _r = run(_cases[_case], _g, _img, parse.repeat)
+            results[_key][_case] = _r
+            print('%-14s %-16s %8.1f ms  %5d ffts  %8.1f MB' % (_key, _case, 1000*_r['time'], _r['ffts'], _r['peak']/2**20))
+    with open(parse.out, 'w') as _f:
+        json.dump(results, _f, indent=2)
+    if parse.baseline:
+        with open(parse.baseline) as _f:
+            if not compare(results, json.load(_f)):
+                sys.exit(1)
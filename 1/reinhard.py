@@ -2,9 +2,11 @@
 import numpy as np
 import cv2 as cv
 from scipy import signal 
+from scipy.fft import next_fast_len
 import sys
 import matplotlib.pyplot as plt
-from rescaling import *                                                                                  
+from rescaling import *
+from writer import Writer
 
 def show(_img, title='Image'): 
     cv.imshow(title,_img) 
@@ -12,89 +14,213 @@ def show(_img, title='Image'):
     cv.destroyAllWindows() 
     cv.waitKey(1)                 
 
+# Center/surround constants (al2 = 1.6*al1)
+_al1 = 1/(2*(2**0.5))
+_al2 = 1.6*_al1
+
+# Relative cost of an FFT (per point, per log2 of size) against a direct multiply-add
+_FFT_COST = 4
+
+# Sampled gaussian exp(-x^2/al^2)/(sqrt(pi)*al) on a circular grid of n points (origin at index 0)
+def gaussian_1d(n, al):
+    pts = np.fft.fftfreq(n, 1/n)
+    return np.exp(-(pts**2)/(al**2))/((np.pi**0.5)*al)
+
+# Support (radius) of the gaussian with parameter al
+def gaussian_radius(al):
+    return int(np.ceil(4*al))
+
+# Planning the transform size, each axis is padded independently
+# by the kernel support, up to a fast (real) FFT length
+def plan_fft(_shp, _r):
+    return tuple(next_fast_len(n+2*_r, True) for n in _shp)
+
+# Whether direct separable convolution beats _n transforms of size _fshp
+def spatial_wins(_shp, _fshp, _r, _n=1):
+    _direct = 2*(2*_r+1)*_shp[0]*_shp[1]
+    _fft = _FFT_COST*_n*_fshp[0]*_fshp[1]*np.log2(_fshp[0]*_fshp[1])
+    return _direct < _fft
+
+# Separable gaussian filtering in the spatial domain (zero border, as in the fourier domain)
+def spatial_gaussian(_img, al):
+    _r = gaussian_radius(al)
+    _k = np.exp(-(np.arange(-_r, _r+1)**2)/(al**2))/((np.pi**0.5)*al)
+    return np.abs(cv.sepFilter2D(np.asarray(_img, dtype=np.float64), cv.CV_64F, _k, _k, borderType=cv.BORDER_CONSTANT))
+
+# Multi-scale gaussian engine
+# The image is padded and transformed only once, the transfer function of every
+# requested kernel is built directly in the fourier domain (as the outer product of
+# the 1D spectra, the kernel being separable), so each scale costs one inverse FFT.
+# Kernels small enough are applied directly instead.
+# @param _img : input image (2D)
+# @param _amax : largest alpha that will be requested (decides the zero padding)
+def gaussian_engine(_img, _amax):
+    _h, _w = _img.shape
+    # Padding (zero) by the support of the largest kernel
+    _r = gaussian_radius(_amax)
+    _shp = plan_fft(_img.shape, _r)
+    # Spectrum of the padded image (computed on first use)
+    _img_f = []
+    # Filtering at alpha al (or at every alpha of a 1D array, as one stack)
+    def _filter(al):
+        _stk = np.ndim(al) > 0
+        if not _stk and spatial_wins(_img.shape, _shp, gaussian_radius(al)):
+            return spatial_gaussian(_img, al)
+        if not _img_f:
+            _pad = np.zeros(_shp)
+            _pad[_r:_r+_h, _r:_r+_w] = _img
+            _img_f.append(np.fft.rfft2(_pad))
+        # Transfer functions (stacked along the first axis), one batched inverse transform
+        al = np.reshape(al, (-1, 1))
+        _tf = np.fft.fft(gaussian_1d(_shp[0], al)).real[:, :, None] * np.fft.rfft(gaussian_1d(_shp[1], al)).real[:, None, :]
+        _new = np.fft.irfft2(_img_f[0]*_tf, s=_shp)
+        # Removing padding
+        _new = np.abs(_new[:, _r:_r+_h, _r:_r+_w])
+        return _new if _stk else _new[0]
+    return _filter
+
+# Gaussian filtering, in the spatial or the fourier domain (whichever is cheaper)
 def apply_gaussian_filter(_img, _std):
-    # Inner Function
-    def gaussian_k(n, al):
-        pts = np.arange((1-n)/2, (n+1)/2, 1)
-        _x, _y = np.meshgrid(pts, pts)
-        _gk = (_x**2 + _y**2)/(al**2)
-        _gk = (1/(np.math.pi * (al**2))) * (np.exp(-_gk))
-        return _gk
-    _sz = max(_img.shape)
-    _sz = _sz + 0 if _sz%2 == 1 else _sz+1
-    _gsk = gaussian_k(_sz, _std)
-    # Padding the image
-    # Getting size H
-    _m = _sz - _img.shape[0]
-    _m1 = _m//2
-    if _m%2 == 1:
-        _m2 = _m1+1
-    else:
-        _m2 = _m1
-    # Getting size V
-    _n = _sz - _img.shape[1]
-    _n1 = _n//2
-    if _n%2 == 1:
-        _n2 = _n1+1
+    _r = gaussian_radius(_std)
+    if spatial_wins(_img.shape, plan_fft(_img.shape, _r), _r, 2):
+        return spatial_gaussian(_img, _std)
+    return gaussian_engine(_img, _std)(_std)
+
+
+# Tone mapping parameters and the scale grid
+_phi = 10
+_a = 0.72
+_scales = np.arange(0.1, 10, 0.1)
+
+# Center and surround responses at scale s
+def center_surround(_gf, s):
+    return _gf(_al1*s), _gf(_al2*s)
+
+# Normalized center-surround difference
+def center_surround_V(V1, V2, s, a=_a, phi=_phi):
+    return (V1-V2)/(abs(V1)+((pow(2, phi)*a)/(s**2)))
+
+def getV(_img, s, a, phi, _gf=None):
+    if _gf is None:
+        _gf = gaussian_engine(_img, _al2*s)
+    V1, V2 = center_surround(_gf, s)
+    return center_surround_V(V1, V2, s, a, phi)
+
+# Luminance (unscaled) of the gamma corrected image
+def lum_of(_img):
+    return _img[:,:,0]*0.299 + _img[:,:,1]*0.587 + _img[:,:,0]*0.114
+
+# Gamma corrected image and its luminance (scaled to 255)
+# @param _rng : range of the (unscaled) luminance over the whole image
+def prepare(_img, _rng=None):
+    _img = gamma_crr(_img)
+    _lum = scale(lum_of(_img), 255, 0, _rng)
+    return _img, _lum
+
+# Mapping the colours from the old luminance to the new
+def lum_map(_img, _ol, _nl):
+    _ni = np.zeros(_img.shape)
+    _ni[:,:,0] = _img[:,:,0]*((_nl/(_ol+0.0001))**0.75)
+    _ni[:,:,1] = _img[:,:,1]*((_nl/(_ol+0.0001))**0.75)
+    _ni[:,:,2] = _img[:,:,2]*((_nl/(_ol+0.0001))**0.75)
+    return _ni
+
+# Finding the first index i (of _n) for which _pred(i) holds, _pred assumed monotone
+# The bracket is found by galloping (0, 1, 3, 7...) and then bisected
+# Returns the index (last one, if never true)
+def bisect_scale(_pred, _n):
+    # Galloping
+    _lo, _hi = -1, 0
+    while not _pred(_hi):
+        if _hi == _n-1:
+            return _hi
+        _lo, _hi = _hi, min(2*_hi+1, _n-1)
+    # Bisection, _pred(_lo) false and _pred(_hi) true
+    while _hi-_lo > 1:
+        _mid = (_lo+_hi)//2
+        if _pred(_mid):
+            _hi = _mid
+        else:
+            _lo = _mid
+    return _hi
+
+# Searching the scale grid for the first scale with V.sum() below _thr
+# Each evaluated scale is memoized, only a handful (O(log n)) are evaluated
+# Returns the triplet (best, s, evaluations)
+def reinhard_search(_img, _scales=_scales, _thr=0.5):
+    _img, _lum = prepare(_img)
+    _gf = gaussian_engine(_lum, _al2*_scales[-1])
+    # Memo of (V.sum(), V1) per scale index
+    _memo = {}
+    def _eval(i):
+        if i not in _memo:
+            V1, V2 = center_surround(_gf, _scales[i])
+            _memo[i] = (center_surround_V(V1, V2, _scales[i]).sum(), V1)
+        return _memo[i]
+    _i = bisect_scale(lambda i: _eval(i)[0] < _thr, len(_scales))
+    _ld = _lum/(1+abs(_eval(_i)[1]))
+    best = scale(lum_map(_img, _lum, _ld), 255)
+    return best, _scales[_i], len(_memo)
+
+# Scales for local adaptation (consecutive ones are 1.6 apart, as al2/al1)
+_local_scales = np.power(1.6, np.arange(8))
+
+# Local adaptation (dodging-and-burning), a scale is picked per pixel
+# Center/surround responses of all scales come as one stack from a single batched
+# inverse transform (with the 1.6 ratio, the surround of a scale is the center of the
+# next one). Per pixel, the largest scale before |V| first reaches _eps is used,
+# found with an argmax along the scale axis.
+# Returns the center response at the picked scales
+def local_center(_lum, _scales=_local_scales, _eps=0.05):
+    _gf = gaussian_engine(_lum, _al2*_scales[-1])
+    _n = len(_scales)
+    # Stack of responses
+    if np.allclose(_scales[1:], 1.6*_scales[:-1]):
+        _R = _gf(np.append(_al1*_scales, _al2*_scales[-1]))
+        V1, V2 = _R[:_n], _R[1:]
     else:
-        _n2 = _n1
-    _img_p = cv.copyMakeBorder(_img, _m1, _m2, _n1, _n2, cv.BORDER_CONSTANT, value=0) 
-    # Going into the fourier domain
-    _img_f = np.fft.fftshift(np.fft.fft2(_img_p))
-    _gsk_f = np.fft.fftshift(np.fft.fft2(_gsk))
-    # Convolution (**Multiplication)
-    _new_f = _img_f*_gsk_f
-    # Inverse Transform
-    _new_p = np.fft.ifft2(_new_f)
-    _new_p = np.fft.ifftshift(_new_p)
-    # Removing Padding
-    _new = _new_p[_m1+1:_sz-_m2+1, _n1+1:_sz-_n2+1]
-    # Return real values
-    # return np.real(_new)
-    return np.abs(_new)
-
-
-def getV(_img, s, a, phi):
-    al1 = 1/(2*(2**0.5))
-    al2 = 1.6*al1
-    V1 = apply_gaussian_filter(_img, al1*s)
-    V2 = apply_gaussian_filter(_img, al2*s)
-    V = (V1-V2)/(abs(V1)+((pow(2, phi)*a)/(s**2)))
-    return V
+        _R = _gf(np.append(_al1*_scales, _al2*_scales))
+        V1, V2 = _R[:_n], _R[_n:]
+    _V = center_surround_V(V1, V2, _scales[:, None, None])
+    # Per pixel scale index
+    _big = np.abs(_V) >= _eps
+    _sm = np.where(_big.any(axis=0), np.maximum(_big.argmax(axis=0)-1, 0), _n-1)
+    return np.take_along_axis(V1, _sm[None], axis=0)[0]
+
+def reinhard_local(_img, _scales=_local_scales, _eps=0.05):
+    _img, _lum = prepare(_img)
+    V1 = local_center(_lum, _scales, _eps)
+    _ld = _lum/(1+abs(V1))
+    return scale(lum_map(_img, _lum, _ld), 255)
 
 def reinhard_map(_img, best_only = False):
-    def lum_map(_img, _ol, _nl):
-        _ni = np.zeros(_img.shape)
-        _ni[:,:,0] = _img[:,:,0]*((_nl/(_ol+0.0001))**0.75)
-        _ni[:,:,1] = _img[:,:,1]*((_nl/(_ol+0.0001))**0.75)
-        _ni[:,:,2] = _img[:,:,2]*((_nl/(_ol+0.0001))**0.75)
-        return _ni
-    _img = gamma_crr(_img)
-    al1 = 1/(2*(2**0.5))
-    _lum = scale(_img[:,:,0]*0.299 + _img[:,:,1]*0.587 + _img[:,:,0]*0.114, 255)
-    phi = 10
-    a = 0.72
+    if best_only:
+        return reinhard_search(_img)[0]
+    _img, _lum = prepare(_img)
     _x = []
     _s = []
-    for s in np.arange(0.1, 10, 0.1):
-        _V = getV(_lum, s, a, phi)
-        V1 = abs(apply_gaussian_filter(_lum, al1*s))
-        _ld = _lum/(1+V1)
-        best = scale(lum_map(_img, _lum, _ld), 255)
-        if not best_only:
-            write('./imgs/v1_'+str(round(s, 2))+'.jpg', best)
-        if((best_only) and (_V.sum() < 0.5)): break
-        _x.append(_V.sum())
-        _s.append(s)
-    if not best_only: 
-        plt.plot(_s, _x)
-        plt.show()
-    if best_only: return best
+    # Luminance is transformed once, for the whole sweep
+    _gf = gaussian_engine(_lum, _al2*_scales[-1])
+    # Frames are written in the background
+    with Writer() as _w:
+        for s in _scales:
+            V1, V2 = center_surround(_gf, s)
+            _V = center_surround_V(V1, V2, s)
+            _ld = _lum/(1+abs(V1))
+            best = scale(lum_map(_img, _lum, _ld), 255)
+            write('./imgs/v1_'+str(round(s, 2))+'.jpg', best, _w)
+            _x.append(_V.sum())
+            _s.append(s)
+    plt.plot(_s, _x)
+    plt.show()
 
 if __name__ == '__main__':
     img = read(sys.argv[1])
     try:
         best = sys.argv[2]
-        write('best.jpg', reinhard_map(img, True)) if best.startswith('T') else reinhard_map(img)
+        if best.startswith('L'):
+            write('local.jpg', reinhard_local(img))
+        else:
+            write('best.jpg', reinhard_map(img, True)) if best.startswith('T') else reinhard_map(img)
     except IndexError:
         reinhard_map(img)
\ No newline at end of file
@@ -2,8 +2,12 @@
 
 import sys
 import cv2 as cv
-import imageio
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import rgbe
+
+# Offset for the luminance (avoiding log(0) and division by 0)
+_delta = 0.00001
 
 # Exception trace printer
 def trace():
@@ -21,74 +25,192 @@ def trace():
     sys.exit(2)
 
 # Read an HDR image
+# Radiance files are decoded natively (rgbe), others go through imageio (FreeImage)
 def read(name : str):
     try:
-        return imageio.imread(name, format='HDR-FI')
+        try:
+            return rgbe.read(name)
+        except ValueError:
+            import imageio
+            return imageio.imread(name, format='HDR-FI')
     except:
         trace()
 
 # Write an jpeg image
-def write(name : str, img : np.array):
+# @param writer : asynchronous writer (writer.Writer) to hand the image to
+def write(name : str, img : np.array, writer = None):
     try:
+        if writer is not None:
+            return writer.submit(name, img[:,:,::-1])
         cv.imwrite(name, img[:,:,::-1])
     except:
         trace()
 
 # Gamma Correction
-def gamma_crr(img : np.array, gm : float = 1/2.2):
+# @param out : preallocated output (may be img itself)
+def gamma_crr(img : np.array, gm : float = 1/2.2, out : np.array = None):
     try:
-        return np.power(img, gm)
+        return np.power(img, gm, out=out)
     except:
         trace()
 
 # Linear Scaling
-def scale(img : np.array, mx : int, mn : int = 0):
+# @param rng : (min, max) of the whole image, when img is only a part of it
+# @param out : preallocated output (may be img itself)
+def scale(img : np.array, mx : int, mn : int = 0, rng : tuple = None, out : np.array = None):
     try:
-        img_scl = mn + ((mx-mn)/(img.max()-img.min())) * (img - img.min())
+        lo, hi = (img.min(), img.max()) if rng is None else rng
+        if out is not None:
+            np.subtract(img, lo, out=out)
+            np.multiply(out, (mx-mn)/(hi-lo), out=out)
+            return np.add(out, mn, out=out)
+        img_scl = mn + ((mx-mn)/(hi-lo)) * (img - lo)
         return img_scl
     except:
         trace()
 
-# Logarithmic-Luminance Scaling
-def log_lum(img : np.array, base : int = 2, bmx : float = 3, bmn : float = 1, al : float = 0.3):
-    try:   
-        _delta = 0.00001
-        img = scale(img, 255)
-        # Seperating RGB Components
-        imgr = np.array(img[:,:,0])         
-        imgb = np.array(img[:,:,2])         
-        imgg = np.array(img[:,:,1])
-        # Getting Luminance
-        lum = imgr*0.299 + imgg*0.587 + imgb*0.114 
+# Luminance
+# @param out : preallocated output
+def luminance(img : np.array, out : np.array = None):
+    try:
+        if out is not None:
+            return np.matmul(img, np.array([0.299, 0.587, 0.114], dtype=out.dtype), out=out)
+        return img[:,:,0]*0.299 + img[:,:,1]*0.587 + img[:,:,2]*0.114
+    except:
+        trace()
+
+# Workspace (preallocated buffers) for the allocation-free mode, for images of shape shp
+# Peak memory is then the input plus 5 planes of dtype
+def workspace(shp : tuple, dtype = np.float32):
+    try:
+        return {'out': np.empty(shp, dtype), 'lum': np.empty(shp[:2], dtype), 'tmp': np.empty(shp[:2], dtype)}
+    except:
+        trace()
+
+# Log-Luminance mapping of an image (already scaled to 255), returned unscaled
+# @param rng : (min, max) of the luminance over the whole image
+def log_map(img : np.array, lum : np.array, base : int = 2, bmx : float = 3, bmn : float = 1, al : float = 0.3, rng : tuple = None):
+    try:
         # Going to log-domain
         log_lum = np.log(lum+_delta)/np.log(base)
         # Scaling in log-domain
-        log_lum = scale(log_lum, bmx, bmn)
+        log_rng = None if rng is None else tuple(np.log(np.array(rng)+_delta)/np.log(base))
+        log_lum = scale(log_lum, bmx, bmn, log_rng)
         # Getting out of log-domain
         new_lum = np.power(base, log_lum/(np.log(255)/np.log(base)))*255
         # Getting new RGB components 
-        imgr = new_lum*((imgr/(lum+_delta))**al) 
-        imgb = new_lum*((imgb/(lum+_delta))**al) 
-        imgg = new_lum*((imgg/(lum+_delta))**al)
+        imgr = new_lum*((img[:,:,0]/(lum+_delta))**al) 
+        imgg = new_lum*((img[:,:,1]/(lum+_delta))**al)
+        imgb = new_lum*((img[:,:,2]/(lum+_delta))**al) 
         # Creating new image
-        new_img = cv.merge([imgr, imgg, imgb])
+        return cv.merge([imgr, imgg, imgb])
+    except:
+        trace()
+
+# Logarithmic-Luminance Scaling, within a workspace (see log_lum)
+def _log_lum_ws(img : np.array, base : int, bmx : float, bmn : float, al : float, ws : dict):
+    out, lum, tmp = ws['out'], ws['lum'], ws['tmp']
+    # Scaled image and its luminance (offset)
+    scale(img, 255, out=out)
+    luminance(out, out=lum)
+    np.add(lum, _delta, out=lum)
+    # Log-domain, scaled (the base only matters when getting out of it)
+    np.log(lum, out=tmp)
+    scale(tmp, bmx, bmn, out=tmp)
+    # Getting out of log-domain, base**(x/log_base(255))*255
+    np.multiply(tmp, np.log(base)**2/np.log(255), out=tmp)
+    np.exp(tmp, out=tmp)
+    np.multiply(tmp, 255, out=tmp)
+    # New RGB components, ratio and power fused over the channels
+    np.divide(out, lum[:,:,None], out=out)
+    np.power(out, al, out=out)
+    np.multiply(out, tmp[:,:,None], out=out)
+    return scale(out, 255, out=out)
+
+# Logarithmic-Luminance Scaling
+# @param ws : workspace (opt-in allocation-free mode), the result is then ws['out']
+def log_lum(img : np.array, base : int = 2, bmx : float = 3, bmn : float = 1, al : float = 0.3, ws : dict = None):
+    try:   
+        if ws is not None:
+            return _log_lum_ws(img, base, bmx, bmn, al, ws)
+        img = scale(img, 255)
+        # Getting Luminance
+        lum = luminance(img)
+        # Mapping in log-domain
+        new_img = log_map(img, lum, base, bmx, bmn, al)
         # Returning image
         return scale(new_img, 255)
     except:
         trace()
 
+# Shared analysis of an image, for any number of renditions
+# Holds the (gamma corrected) image and its range, the image scaled to 255, its
+# luminance, the normalized log-luminance (in [0, 1], the same for every base)
+# and the colour ratios
+# @param gm : gamma (None if img is already corrected)
+def analyse(img : np.array, gm : float = None):
+    try:
+        if gm is not None:
+            img = gamma_crr(img, gm)
+        an = {'img': img, 'range': (img.min(), img.max())}
+        an['scaled'] = scale(img, 255, 0, an['range'])
+        an['lum'] = luminance(an['scaled'])
+        an['log'] = scale(np.log(an['lum']+_delta), 1, 0)
+        an['ratio'] = an['scaled']/(an['lum']+_delta)[:,:,None]
+        return an
+    except:
+        trace()
+
+# Linear Scaling, from the analysis
+def linear_from(an : dict, mx : int, mn : int = 0):
+    try:
+        return scale(an['img'], mx, mn, an['range'])
+    except:
+        trace()
+
+# Logarithmic-Luminance Scaling, from the analysis (as log_lum)
+def log_from(an : dict, base : int = 2, bmx : float = 3, bmn : float = 1, al : float = 0.3):
+    try:
+        # Scaled log-luminance (in base)
+        log_lum = bmn + (bmx-bmn)*an['log']
+        # Getting out of log-domain
+        new_lum = np.power(base, log_lum/(np.log(255)/np.log(base)))*255
+        # Getting new RGB components
+        new_img = new_lum[:,:,None]*(an['ratio']**al)
+        return scale(new_img, 255)
+    except:
+        trace()
+
+# Rendition of the analysis for one parameter set
+# Log-luminance if 'base' is a parameter (base, bmx, bmn, al), linear otherwise (mx, mn)
+def render(an : dict, params : dict):
+    return log_from(an, **params) if 'base' in params else linear_from(an, **params)
+
+# Any number of renditions of one image, sharing a single analysis
+# @param params : list of parameter sets (see render)
+# @param workers : size of the thread pool (0, sequential)
+def renditions(img : np.array, params : list, gm : float = None, workers : int = 0):
+    an = analyse(img, gm)
+    if workers:
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(lambda p: render(an, p), params))
+    return [render(an, p) for p in params]
+
 # Main
 # Completes Part-1 of Assignment
 if __name__ == '__main__':
     try:
-        # Reading image and correcting it with gamma correction
-        img = gamma_crr(read(sys.argv[1]))
-        # Linearly Scaling
-        write('img_max__ign.jpg', scale(img, 255, 0)) # Fitting all in range (lower values are lost)
-        write('img_middle__ign.jpg', scale(img, 4000, 0)) # Middle fitting (decent)
-        write('img_min__ign.jpg', scale(img, 10000, 0)) # Fitting lower values (higher are lost)
-        # Log Scaling with various parameters
-        write('log_base_3.jpg', log_lum(img, base=3, bmn=1, bmx=6, al=0.8)) # Another base
-        write('log_base_10.jpg', log_lum(img, base=10, bmn=0.1, bmx=2.1, al=0.8)) # (Default)
+        # Reading image (corrected with gamma correction in the analysis)
+        outs = {
+            'img_max__ign.jpg': {'mx': 255, 'mn': 0}, # Fitting all in range (lower values are lost)
+            'img_middle__ign.jpg': {'mx': 4000, 'mn': 0}, # Middle fitting (decent)
+            'img_min__ign.jpg': {'mx': 10000, 'mn': 0}, # Fitting lower values (higher are lost)
+            # Log Scaling with various parameters
+            'log_base_3.jpg': {'base': 3, 'bmn': 1, 'bmx': 6, 'al': 0.8}, # Another base
+            'log_base_10.jpg': {'base': 10, 'bmn': 0.1, 'bmx': 2.1, 'al': 0.8}, # (Default)
+        }
+        imgs = renditions(read(sys.argv[1]), list(outs.values()), gm=1/2.2)
+        for name, new_img in zip(outs, imgs):
+            write(name, new_img)
     except:
         trace()
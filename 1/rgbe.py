@@ -0,0 +1,217 @@
+# Reader/Writer for Radiance HDR (RGBE) images
+# Whole images are decoded by OpenCV's RGBE codec. Bands of rows are read from the
+# memory mapped file: run-length encoded scanlines are parsed into run descriptors
+# and expanded (and converted to float) with vectorized numpy straight into a
+# float32 buffer, which the caller may provide.
+
+import os
+import sys
+import mmap
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2 as cv
+
+# Scanline offsets of the files recently visited, keyed by (path, size, mtime)
+# (least recently used files go first)
+_offsets = OrderedDict()
+_offsets_lock = threading.Lock()
+_offsets_max = 16
+
+
+# Parsing the header
+# Returns (height, width, offset of the pixel data)
+def header(_buf):
+    _end = _buf.find(b'\n\n')
+    if not _buf[:2] == b'#?' or _end < 0:
+        raise ValueError('Not a Radiance HDR file')
+    for _line in _buf[:_end].split(b'\n'):
+        if _line.startswith(b'FORMAT=') and _line.strip() != b'FORMAT=32-bit_rle_rgbe':
+            raise ValueError('Unsupported format ' + _line.decode())
+    # Resolution string
+    _pos = _end+2
+    _eol = _buf.find(b'\n', _pos)
+    _res = _buf[_pos:_eol].split()
+    if len(_res) != 4 or _res[0] != b'-Y' or _res[2] != b'+X':
+        raise ValueError('Unsupported orientation ' + _buf[_pos:_eol].decode())
+    return int(_res[1]), int(_res[3]), _eol+1
+
+
+# Whether the scanlines are (new style) run-length encoded
+def _rle(_buf, _pos, _w):
+    return 8 <= _w < 0x8000 and _buf[_pos:_pos+4] == bytes([2, 2, _w >> 8, _w & 255])
+
+
+# Parsing a RLE scanline (4 planes of _w bytes) at _pos, as runs
+# Appends (source, count, literal) of every run, returns the next scanline offset
+def _runs(_buf, _pos, _w, _src, _cnt, _lit):
+    if _buf[_pos:_pos+2] != b'\x02\x02':
+        raise ValueError('Bad scanline at ' + str(_pos))
+    _pos += 4
+    for _ in range(4):
+        _n = 0
+        while _n < _w:
+            _c = _buf[_pos]
+            # Run of one byte
+            if _c > 128:
+                _c -= 128
+                _src.append(_pos+1)
+                _lit.append(0)
+                _pos += 2
+            # Literal bytes
+            elif _c > 0:
+                _src.append(_pos+1)
+                _lit.append(1)
+                _pos += _c+1
+            else:
+                raise ValueError('Bad run at ' + str(_pos))
+            _cnt.append(_c)
+            _n += _c
+        if _n != _w:
+            raise ValueError('Overrun in scanline')
+    return _pos
+
+
+# Offsets of the scanlines of a file (shared, only ever extended)
+def _file_offsets(_name, _data):
+    _st = os.stat(_name)
+    _key = (os.path.abspath(_name), _st.st_size, _st.st_mtime)
+    with _offsets_lock:
+        if _key in _offsets:
+            _offsets.move_to_end(_key)
+        else:
+            _offsets[_key] = [_data]
+            while len(_offsets) > _offsets_max:
+                _offsets.popitem(last=False)
+        return _offsets[_key]
+
+# Recording the offsets _new of the scanlines from _r on (parsed without the lock)
+def _extend(_off, _r, _new):
+    with _offsets_lock:
+        if len(_off) < _r+len(_new):
+            _off.extend(_new[len(_off)-_r:])
+
+# Offsets of the scanlines [0, _r1] (the last one is where scanline _r1 starts)
+def _scanlines(_name, _buf, _data, _w, _r1):
+    _off = _file_offsets(_name, _data)
+    _n = len(_off)
+    if _n <= _r1:
+        _src, _cnt, _lit = [], [], []
+        _new = [_off[_n-1]]
+        while _n-1+len(_new) <= _r1:
+            _new.append(_runs(_buf, _new[-1], _w, _src, _cnt, _lit))
+            del _src[:], _cnt[:], _lit[:]
+        _extend(_off, _n, _new[1:])
+    return _off
+
+
+# Converting RGBE bytes (..., 4) to float into _out (..., 3)
+def _to_float(_rgbe, _out):
+    _e = _rgbe[..., 3].astype(np.int32)
+    _f = np.where(_e > 0, np.ldexp(np.float32(1), _e-136), np.float32(0))
+    np.multiply(_rgbe[..., :3], _f[..., None], out=_out)
+    return _out
+
+
+# Shape of the image (h, w, 3)
+def shape(_name: str) -> tuple:
+    with open(_name, 'rb') as _f:
+        with mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as _buf:
+            _h, _w, _ = header(_buf)
+    return (_h, _w, 3)
+
+
+# Decoding the rows [_r0, _r1) of the mapped file into _out
+def _decode(_name, _buf, _h, _w, _data, _r0, _r1, _out):
+    _bytes = np.frombuffer(_buf, dtype=np.uint8)
+    # Flat scanlines (pixels of 4 bytes)
+    if not _rle(_buf, _data, _w):
+        _rgbe = _bytes[_data+4*_w*_r0:_data+4*_w*_r1].reshape(_r1-_r0, _w, 4)
+        return _to_float(_rgbe, _out)
+    # RLE scanlines, runs of the band
+    _off = _scanlines(_name, _buf, _data, _w, _r0)
+    _src, _cnt, _lit = [], [], []
+    _new = [_off[_r0]]
+    for _r in range(_r0, _r1):
+        _new.append(_runs(_buf, _new[-1], _w, _src, _cnt, _lit))
+    _extend(_off, _r0+1, _new[1:])
+    # Expanding the runs (gathering with one index array)
+    _cnt = np.array(_cnt, dtype=np.int64)
+    _idx = np.repeat(np.array(_src, dtype=np.int64), _cnt)
+    _step = np.arange(_idx.size) - np.repeat(np.cumsum(_cnt)-_cnt, _cnt)
+    _idx += _step*np.repeat(np.array(_lit, dtype=np.int64), _cnt)
+    # Planes (rows, 4, w) to pixels (rows, w, 4)
+    _rgbe = _bytes[_idx].reshape(_r1-_r0, 4, _w).transpose(0, 2, 1)
+    return _to_float(_rgbe, _out)
+
+
+# Reading an HDR image (or the band of rows [r0, r1))
+# @param _name : path of the file
+# @param _out : buffer of shape (r1-r0, w, 3) to decode into (optional, C ordered float32 is fastest)
+# @param _rows : (r0, r1), band of rows (optional)
+def read(_name: str, _out: np.ndarray = None, _rows: tuple = None) -> np.ndarray:
+    with open(_name, 'rb') as _f:
+        with mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as _buf:
+            _h, _w, _data = header(_buf)
+            _r0, _r1 = (0, _h) if _rows is None else _rows
+            if not 0 <= _r0 <= _r1 <= _h:
+                raise ValueError('Invalid rows ' + str(_rows))
+            if _out is not None and _out.shape != (_r1-_r0, _w, 3):
+                raise ValueError('Output of shape ' + str(_out.shape) + ', expected ' + str((_r1-_r0, _w, 3)))
+            # Whole image, OpenCV's codec (BGR), only when its result can be the output
+            # (swapped in place) or written straight into a C ordered float32 buffer
+            _direct = _out is None or (_out.dtype == np.float32 and _out.flags.c_contiguous)
+            if (_r0, _r1) == (0, _h) and _direct:
+                _img = cv.imread(_name, cv.IMREAD_UNCHANGED)
+                if _img is not None and _img.shape == (_h, _w, 3) and _img.dtype == np.float32:
+                    return cv.cvtColor(_img, cv.COLOR_BGR2RGB, dst=_img if _out is None else _out)
+            if _out is None:
+                _out = np.empty((_r1-_r0, _w, 3), dtype=np.float32)
+            return _decode(_name, _buf, _h, _w, _data, _r0, _r1, _out)
+
+
+# Writing an HDR image (flat scanlines)
+# @param _name : path of the file
+# @param _img : float image (h, w, 3), RGB
+def write(_name: str, _img: np.ndarray) -> None:
+    _h, _w = _img.shape[:2]
+    _v = _img.max(axis=2)
+    _m, _e = np.frexp(_v)
+    _ok = _v > 1e-32
+    _rgbe = np.zeros((_h, _w, 4), dtype=np.uint8)
+    _rgbe[..., :3] = _img*np.where(_ok, _m*256/np.where(_ok, _v, 1), 0)[..., None]
+    _rgbe[..., 3] = np.where(_ok, _e+128, 0)
+    with open(_name, 'wb') as _f:
+        _f.write(b'#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n')
+        _f.write(('-Y %d +X %d\n' % (_h, _w)).encode())
+        _f.write(_rgbe.tobytes())
+
+
+# Main
+# Benchmarks decoding of the given files (argv[1:]), whole and by bands, against imageio (if present)
+if __name__ == '__main__':
+    for _name in sys.argv[1:]:
+        _img = read(_name)
+        _best = np.inf
+        for _ in range(5):
+            _t = time.perf_counter()
+            read(_name, _img)
+            _best = min(_best, time.perf_counter()-_t)
+        print('%s : %s, decode %.1f ms' % (_name, _img.shape, 1000*_best))
+        # By bands of 64 rows (as tiled reads do)
+        _band = np.empty_like(_img)
+        with _offsets_lock:
+            _offsets.clear()
+        _t = time.perf_counter()
+        for _r in range(0, _img.shape[0], 64):
+            _r1 = min(_r+64, _img.shape[0])
+            read(_name, _band[_r:_r1], (_r, _r1))
+        print('    bands %.1f ms, max difference %g' % (1000*(time.perf_counter()-_t), np.abs(_band-_img).max()))
+        try:
+            import imageio
+            _t = time.perf_counter()
+            _ref = imageio.imread(_name, format='HDR-FI')
+            print('    imageio %.1f ms, max difference %g' % (1000*(time.perf_counter()-_t), np.abs(_ref-_img).max()))
+        except Exception as _e:
+            print('    imageio unavailable (' + type(_e).__name__ + ')')
@@ -0,0 +1,126 @@
+# Tiled (strip by strip) tone mapping, for HDR images too large for memory
+# The input only needs row slicing (a np.memmap works) and the output is written
+# strip by strip into _out (e.g. np.lib.format.open_memmap), so the peak memory is
+# bounded by the strip size. Global statistics (ranges, V sums) come from cheap
+# earlier passes over the strips, gaussian filtering reads a halo of rows around each
+# strip, covering the kernel support.
+
+import sys
+import tempfile
+import numpy as np
+import rgbe
+from rescaling import gamma_crr, scale, luminance, log_map
+from reinhard import gaussian_engine, gaussian_radius, center_surround, center_surround_V, \
+    prepare, lum_of, lum_map, local_center, bisect_scale, _al2, _scales, _local_scales
+
+# Default strip height
+_rows = 256
+
+# Strips of the rows as (r0, r1, p0, p1), rows [p0, p1) include a halo of _halo rows
+def strips(_h, _rows=_rows, _halo=0):
+    for r0 in range(0, _h, _rows):
+        r1 = min(r0+_rows, _h)
+        yield r0, r1, max(r0-_halo, 0), min(r1+_halo, _h)
+
+# Range (min, max) of _fn over all the strips
+def tiled_range(_img, _fn=np.asarray, _rows=_rows):
+    lo, hi = np.inf, -np.inf
+    for r0, r1, _, _ in strips(_img.shape[0], _rows):
+        _x = _fn(_img[r0:r1])
+        lo, hi = min(lo, _x.min()), max(hi, _x.max())
+    return lo, hi
+
+# Output buffer (allocated, if not given)
+def _output(_img, _out):
+    return np.empty(_img.shape) if _out is None else _out
+
+# Scaling the output in place, strip by strip
+def _rescale(_out, mx, mn, rng, _rows=_rows):
+    for r0, r1, _, _ in strips(_out.shape[0], _rows):
+        _out[r0:r1] = scale(_out[r0:r1], mx, mn, rng)
+    return _out
+
+# Gamma correction (optional) of a strip
+def _gamma(gm):
+    return np.asarray if gm is None else (lambda x: gamma_crr(x, gm))
+
+# Linear scaling (after an optional gamma correction)
+def tiled_scale(_img, mx, mn=0, gm=None, _out=None, _rows=_rows):
+    _fn = _gamma(gm)
+    rng = tiled_range(_img, _fn, _rows)
+    _out = _output(_img, _out)
+    for r0, r1, _, _ in strips(_img.shape[0], _rows):
+        _out[r0:r1] = scale(_fn(_img[r0:r1]), mx, mn, rng)
+    return _out
+
+# Logarithmic-Luminance scaling (after an optional gamma correction)
+def tiled_log_lum(_img, base=2, bmx=3, bmn=1, al=0.3, gm=None, _out=None, _rows=_rows):
+    _fn = _gamma(gm)
+    # Image range, then luminance range (of the image scaled to 255)
+    rng = tiled_range(_img, _fn, _rows)
+    _sc = lambda x: scale(_fn(x), 255, 0, rng)
+    lrng = tiled_range(_img, lambda x: luminance(_sc(x)), _rows)
+    # Mapping, and range of the mapped image
+    _out = _output(_img, _out)
+    lo, hi = np.inf, -np.inf
+    for r0, r1, _, _ in strips(_img.shape[0], _rows):
+        _x = _sc(_img[r0:r1])
+        _y = log_map(_x, luminance(_x), base, bmx, bmn, al, lrng)
+        _out[r0:r1] = _y
+        lo, hi = min(lo, _y.min()), max(hi, _y.max())
+    return _rescale(_out, 255, 0, (lo, hi), _rows)
+
+# Reinhard mapping of the strips, given the center response of a (haloed) luminance strip
+def _tiled_map(_img, _V1, _halo, _out, _rows):
+    lrng = tiled_range(_img, lambda x: lum_of(gamma_crr(x)), _rows)
+    _out = _output(_img, _out)
+    lo, hi = np.inf, -np.inf
+    for r0, r1, p0, p1 in strips(_img.shape[0], _rows, _halo):
+        _g, _lum = prepare(_img[p0:p1], lrng)
+        V1 = _V1(_lum)[r0-p0:r1-p0]
+        _g, _lum = _g[r0-p0:r1-p0], _lum[r0-p0:r1-p0]
+        _y = lum_map(_g, _lum, _lum/(1+abs(V1)))
+        _out[r0:r1] = _y
+        lo, hi = min(lo, _y.min()), max(hi, _y.max())
+    return _rescale(_out, 255, 0, (lo, hi), _rows)
+
+# Reinhard local adaptation (as reinhard.reinhard_local)
+def tiled_reinhard_local(_img, _scales=_local_scales, _eps=0.05, _out=None, _rows=_rows):
+    _halo = gaussian_radius(_al2*_scales[-1])
+    return _tiled_map(_img, lambda _lum: local_center(_lum, _scales, _eps), _halo, _out, _rows)
+
+# Reinhard global scale search (as reinhard.reinhard_search)
+# Each evaluated scale is one pass over the strips, accumulating V.sum()
+# Returns the triplet (best, s, evaluations)
+def tiled_reinhard_search(_img, _scales=_scales, _thr=0.5, _out=None, _rows=_rows):
+    lrng = tiled_range(_img, lambda x: lum_of(gamma_crr(x)), _rows)
+    _memo = {}
+    def _vsum(i):
+        if i not in _memo:
+            s = _scales[i]
+            _halo = gaussian_radius(_al2*s)
+            _sum = 0
+            for r0, r1, p0, p1 in strips(_img.shape[0], _rows, _halo):
+                _lum = prepare(_img[p0:p1], lrng)[1]
+                V1, V2 = center_surround(gaussian_engine(_lum, _al2*s), s)
+                _sum += center_surround_V(V1, V2, s)[r0-p0:r1-p0].sum()
+            _memo[i] = _sum
+        return _memo[i]
+    _i = bisect_scale(lambda i: _vsum(i) < _thr, len(_scales))
+    s = _scales[_i]
+    _V1 = lambda _lum: center_surround(gaussian_engine(_lum, _al2*s), s)[0]
+    best = _tiled_map(_img, _V1, gaussian_radius(_al2*s), _out, _rows)
+    return best, s, len(_memo)
+
+
+# Main
+# Tone maps (local Reinhard) argv[1] into the .npy file argv[2], without loading it whole
+# (the input is decoded, band by band, into a temporary memory map)
+if __name__ == '__main__':
+    shp = rgbe.shape(sys.argv[1])
+    img = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shp)
+    for r0, r1, _, _ in strips(shp[0]):
+        rgbe.read(sys.argv[1], img[r0:r1], (r0, r1))
+    out = np.lib.format.open_memmap(sys.argv[2], mode='w+', dtype=np.float32, shape=shp)
+    tiled_reinhard_local(img, _out=out)
+    out.flush()
@@ -0,0 +1,69 @@
+# Asynchronous image writer
+# Frames are handed to a small pool of threads through a bounded queue, so encoding
+# and disk latency overlap with the computation. submit blocks while the queue is
+# full (backpressure), flush/close wait for the pending frames and raise the first
+# error met while writing.
+
+import queue
+import threading
+import cv2 as cv
+
+
+class Writer:
+
+    # @param workers : number of writing threads
+    # @param size : number of frames allowed to wait in the queue
+    def __init__(self, workers: int = 2, size: int = 8):
+        self._queue = queue.Queue(size)
+        self._errors = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for _t in self._threads:
+            _t.start()
+
+    # Worker loop (None stops it)
+    def _run(self):
+        while True:
+            _item = self._queue.get()
+            try:
+                if _item is None:
+                    return
+                _name, _img = _item
+                if not cv.imwrite(_name, _img):
+                    raise IOError('Could not write ' + _name)
+            except Exception as _e:
+                with self._lock:
+                    self._errors.append(_e)
+            finally:
+                self._queue.task_done()
+
+    # Queueing a frame (the array must not be modified until it is written)
+    def submit(self, _name: str, _img) -> None:
+        if self._closed:
+            raise ValueError('Writer is closed')
+        self._queue.put((_name, _img))
+
+    # Waiting for the queued frames, raising the first error (if any)
+    def flush(self) -> None:
+        self._queue.join()
+        with self._lock:
+            _errors, self._errors = self._errors, []
+        if _errors:
+            raise _errors[0]
+
+    # Flushing and stopping the threads
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            for _t in self._threads:
+                _t.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
@@ -2,34 +2,72 @@
 import sys
 import numpy as np
 import cv2 as cv
+from functools import lru_cache
+from fft import RFFT, IRFFT, expand
 from mio import read, write, show, trace
 from noising import add_noise
 
 
+# Radius (kernel half size) from which discs are blurred in the fourier domain
+_fft_radius = 32
+
+
+# Disc-shaped kernel (cached, read-only)
+# Anti-aliased edges take the covered area of each pixel (_ss x _ss samples)
+@lru_cache(maxsize=64)
+def _disc(n: int, r: float, _aa: bool, _ss: int = 8):
+    if _aa:
+        # Sub-pixel sample positions
+        _p = (np.arange((2*n+1)*_ss) + 0.5)/_ss - (n+0.5)
+        _in = (_p[:, None]**2 + _p[None, :]**2) <= (n/r)**2
+        _m = _in.reshape(2*n+1, _ss, 2*n+1, _ss).mean(axis=(1, 3))
+    else:
+        _p = np.arange(-n, n+1)
+        _m = ((_p[:, None]**2 + _p[None, :]**2) <= (n/r)**2).astype(np.float64)
+    _m /= _m.sum()
+    _m.setflags(write=False)
+    return _m
+
+
 # Function for getting disc-shaped h(x, y)
 # @param n : radius of kernel/disc
 # @param r : ratio of kernel/disc radius (default 1)
-def disc(n: int, r: int = 1):
+# @param _aa : anti-aliased edges
+def disc(n: int, r: int = 1, _aa: bool = False):
     try:
-        _m = np.ones((2*n+1, 2*n+1))
-        for i in range(n+1):
-            for j in range(n+1):
-                if ((i-n)**2 + (j-n)**2)**0.5 > n/r:
-                    _m[i, j] = 0
-                    _m[2*n-i, j] = 0
-                    _m[2*n-i, 2*n-j] = 0
-                    _m[i, 2*n-j] = 0
-        return _m/_m.sum()
+        return _disc(n, r, _aa)
     except:
         trace()
 
 
+# Convolution with a (symmetric) kernel in the fourier domain
+# Border reflected as in cv.filter2D, channels go through one batched transform
+def fft_filter(_img: np.ndarray, _k: np.ndarray) -> np.ndarray:
+    _n, _m = _k.shape[0]//2, _k.shape[1]//2
+    _h, _w = _img.shape[:2]
+    _pad = cv.copyMakeBorder(np.float32(_img), _n, _n, _m, _m, cv.BORDER_REFLECT_101)
+    __shp = _pad.shape[:2]
+    _K = expand(RFFT(np.float32(_k), __shp), _pad.ndim)
+    _out = IRFFT(RFFT(_pad, __shp)*_K, __shp)
+    return _out[2*_n:2*_n+_h, 2*_m:2*_m+_w]
+
+
 # Blurring the image with disc
+# Small discs are convolved in the spatial domain, large ones in the fourier domain
 # @param _img : input image
 # @param _n : size of the kernel
-def disc_blur(_img: np.array, _n: int):
+# @param _float : keep a float (32 bit) output, instead of 8 bit
+# @param _aa : anti-aliased disc
+def disc_blur(_img: np.array, _n: int, _float: bool = False, _aa: bool = False):
     try:
-        _nimg = cv.filter2D(_img, cv.CV_8U, disc(_n, 3))
+        _k = disc(_n, 3, _aa)
+        # Cropping the (symmetric) zero border of the kernel
+        _k = _k[np.ix_(_k.any(axis=1), _k.any(axis=0))]
+        if _k.shape[0]//2 < _fft_radius:
+            _nimg = cv.filter2D(_img, cv.CV_32F if _float else cv.CV_8U, _k)
+        else:
+            _nimg = fft_filter(_img, _k)
+            _nimg = np.float32(_nimg) if _float else np.uint8(np.clip(np.rint(_nimg), 0, 255))
         if _nimg is None:
             raise ValueError('Convolution unsucessful.')
         return _nimg
@@ -62,6 +100,7 @@ def blur(_img: np.array, _size: int, _type: str = 'ME'):
 
 # Function for blurring an image aroung the edges 
 # This is done so as to reduce the ringing effect induced while recovering the image in fourier domain
+# (the merging constants broadcast over the channels, without full size temporaries)
 # @param _img: image to be blurred
 # @param _d: depth og blurring
 def blur_edge(_img: np.ndarray, _d: int = 31, _bw: bool = False): 
@@ -71,22 +110,20 @@ def blur_edge(_img: np.ndarray, _d: int = 31, _bw: bool = False):
     __pad = cv.copyMakeBorder(_img, _d, _d, _d, _d, cv.BORDER_WRAP) 
     # Getting the blur component
     _img_blur = cv.GaussianBlur(__pad, (2*_d+1, 2*_d+1), -1)[_d:-_d,_d:-_d] 
-    # Getting the merging constants
-    _y, _x = np.indices((_h, _w)) 
-    __dist = np.dstack([_x, _w-_x-1, _y, _h-_y-1]).min(-1)
+    # Getting the merging constants (distance to the frame, as an outer minimum)
+    _y, _x = np.arange(_h, dtype=np.float32), np.arange(_w, dtype=np.float32)
+    __dist = np.minimum(np.minimum(_y, _h-_y-1)[:, None], np.minimum(_x, _w-_x-1)[None, :])
     # The constants 
-    _c = np.minimum(np.float32(__dist)/_d, 1.0) 
-    # Checking if BW
-    if _bw:
-        return _img*_c + _img_blur*(1-_c)
-    # Temporary matrix
-    _temp = np.ones(_img.shape) 
-    # Applying on domains
-    for i in [0,1,2]: 
-        _temp[:,:,i] *= _img[:,:,i]*_c 
-        _img_blur[:,:,i] *= (1-_c)
+    _c = np.minimum(__dist/_d, 1.0) 
+    # Applying on all domains (channels)
+    if _img.ndim == 3:
+        _c = _c[:, :, None]
+    # c*img + (1-c)*blur, in a single output
+    _out = np.subtract(_img, _img_blur, dtype=np.result_type(_img.dtype, np.float32))
+    _out *= _c
+    _out += _img_blur
     # Returning the image 
-    return _temp + _img_blur                                                   
+    return _out
 
 
 
@@ -3,13 +3,182 @@ Library for deblurring images...
 Contains various techniques, such as Wiener Filter, Blind Deconvolution...
 '''
 
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 import cv2 as cv
 
-from fft import FFT, IFFT
+from fft import RFFT, IRFFT, OTF, expand
 from mio import show, trace
+from blurring import blur_edge
+
+from denoising import tv_workspace, _diff, _diff_t
+from metric import score_stack
+
+# Cache of PSF spectra and Weiner filters, least recently used entries go first
+# Keyed by the PSF content, the transform shape and the regularization
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'maxsize': 32}
+
+# Key of a PSF (content) with the other parameters
+def _key(_h: np.ndarray, *_args) -> tuple:
+    _h = np.ascontiguousarray(_h)
+    return (hashlib.sha1(_h.tobytes()).hexdigest(), _h.shape, _h.dtype.str) + _args
+
+# Looking up (or building and storing) an entry
+def _cached(_k: tuple, _build):
+    with _cache_lock:
+        if _k in _cache:
+            _cache_stats['hits'] += 1
+            _cache.move_to_end(_k)
+            return _cache[_k]
+        _cache_stats['misses'] += 1
+    _v = _build()
+    _v.setflags(write=False)
+    with _cache_lock:
+        _cache[_k] = _v
+        while len(_cache) > _cache_stats['maxsize']:
+            _cache.popitem(last=False)
+            _cache_stats['evictions'] += 1
+    return _v
+
+# Statistics of the cache (hits, misses, evictions, size, maxsize)
+def cache_info() -> dict:
+    with _cache_lock:
+        return dict(_cache_stats, size=len(_cache))
+
+# Emptying the cache (and its counters)
+def cache_clear() -> None:
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats.update(hits=0, misses=0, evictions=0)
+
+# Changing the number of entries held
+def cache_resize(_n: int) -> None:
+    with _cache_lock:
+        _cache_stats['maxsize'] = _n
+        while len(_cache) > _n:
+            _cache.popitem(last=False)
+            _cache_stats['evictions'] += 1
+
+# Spectrum (OTF) of a PSF for transforms of shape _shp (cached)
+def psf_spectrum(_h: np.ndarray, _shp: tuple) -> np.ndarray:
+    return _cached(_key(_h, 'H', tuple(_shp)), lambda: OTF(_h, _shp))
+
+# Weiner filter H* / (abs(H)**2 + K) for transforms of shape _shp (cached)
+def weiner_filter(_h: np.ndarray, _shp: tuple, K: float) -> np.ndarray:
+    def _build():
+        H = psf_spectrum(_h, _shp)
+        return np.conj(H) / (abs(H)**2 + K)
+    return _cached(_key(_h, 'W', tuple(_shp), float(K)), _build)
+
+# Difference kernels (along x and y) of the TV regularizer
+_dx = np.array([[1., -1.]])
+_dy = _dx.T
+
+# Spectrum of the (periodic) difference operator, |Dx|**2 + |Dy|**2 (cached)
+def difference_spectrum(_shp: tuple) -> np.ndarray:
+    def _build():
+        return abs(OTF(_dx, _shp))**2 + abs(OTF(_dy, _shp))**2
+    return _cached(_key(_dx, 'D', tuple(_shp)), _build)
+
+# Denominator of the TV deconvolution solve, abs(H)**2 + rho*(|Dx|**2 + |Dy|**2) (cached)
+def tv_denominator(_h: np.ndarray, _shp: tuple, _rho: float) -> np.ndarray:
+    def _build():
+        return abs(psf_spectrum(_h, _shp))**2 + _rho*difference_spectrum(_shp)
+    return _cached(_key(_h, 'TV', tuple(_shp), float(_rho)), _build)
+
+# Weiner Filtering over a stack (channels, frames...) sharing one PSF
+# The filter is built once and all the planes go through one batched transform
+# param _imgs : noisy/blurry images, spatial axes at _axes (default, (H, W, ...))
+# param _h : estimate of the PSF
+# param SNR: snr value estimate for the images
+def weiner_stack(_imgs: np.ndarray, _h: np.ndarray, SNR: float = 0.00000001, _axes: tuple = (0, 1)):
+    try:
+        __shp = tuple(_imgs.shape[_a] for _a in _axes)
+        # Getting the inverse filter (cached)
+        H_w = weiner_filter(_h, __shp, SNR)
+        # Getting the images back...
+        F_rec = RFFT(_imgs, __shp, _axes) * expand(H_w, _imgs.ndim, _axes)
+        # Coming back to spatial domain
+        return IRFFT(F_rec, __shp, _axes)
+    except:
+        trace()
+
+# Deconvolving one tile (apodized with blur_edge), returns (r, c, restored tile)
+def _weiner_tile(_args):
+    _r, _c, _tile, _h, SNR, _d = _args
+    return _r, _c, weiner_stack(blur_edge(_tile, _d), _h, SNR)
+
+# Blending window of a tile, ramping over the overlap
+def _window(_n: int, _ov: int) -> np.ndarray:
+    _i = np.arange(_n) + 0.5
+    return np.minimum(1, np.minimum(_i, _n-_i)/max(_ov, 1))
+
+# Tile origins along an axis (the last tile is moved back to fit)
+def _origins(_n: int, _tile: int, _ov: int) -> list:
+    if _n <= _tile:
+        return [0]
+    if _ov >= _tile:
+        raise ValueError('Overlap ' + str(_ov) + ' should be smaller than the tile ' + str(_tile))
+    _o = list(range(0, _n-_tile, _tile-_ov))
+    return _o + [_n-_tile]
 
-from denoising import total_variation_norm
+# Tiled Weiner Filtering, for images too large for one transform
+# Overlapping tiles are apodized (blur_edge), deconvolved in a pool of workers, and
+# blended back with overlap-add. Memory used per tile is bounded by the tile size.
+# Tiles share their shape, so their filter comes from the cache.
+# param _img : noisy/blurry image (H, W) or (H, W, C)
+# param _h : estimate of the PSF, or a function _h(r, c) of the tile origin (spatially varying PSF)
+# param SNR : snr value estimate for the image
+# param _tile : size of the tiles
+# param _overlap : overlap of consecutive tiles (at least the PSF size)
+# param _workers : number of workers (0 for none)
+# param _pool : 'thread' or 'process' workers
+def weiner_tiled(_img: np.ndarray, _h, SNR: float = 0.00000001, _tile: int = 512, _overlap: int = 64, _workers: int = 0, _pool: str = 'thread'):
+    _H, _W = _img.shape[:2]
+    _th, _tw = min(_tile, _H), min(_tile, _W)
+    # Checking the geometry (tiles must overlap less than their size, apodization fit in a tile)
+    if _overlap >= _tile and max(_H, _W) > _tile:
+        raise ValueError('Overlap ' + str(_overlap) + ' should be smaller than the tile ' + str(_tile))
+    if 2*max(_overlap//2, 1) > min(_th, _tw):
+        raise ValueError('Apodization depth ' + str(max(_overlap//2, 1)) + ' does not fit in a tile of ' + str((_th, _tw)))
+    try:
+        # Accumulators
+        _out = np.zeros(_img.shape)
+        _wsum = np.zeros((_H, _W))
+        _win = np.outer(_window(_th, _overlap), _window(_tw, _overlap))
+        _wex = _win[:, :, None] if _img.ndim == 3 else _win
+        # Tasks (tiles)
+        _tasks = ((_r, _c, _img[_r:_r+_th, _c:_c+_tw], _h(_r, _c) if callable(_h) else _h, SNR, max(_overlap//2, 1))
+                  for _r in _origins(_H, _th, _overlap) for _c in _origins(_W, _tw, _overlap))
+        # Overlap-add
+        def _add(_res):
+            _r, _c, _f = _res
+            _out[_r:_r+_th, _c:_c+_tw] += _f*_wex
+            _wsum[_r:_r+_th, _c:_c+_tw] += _win
+        if not _workers:
+            for _t in _tasks:
+                _add(_weiner_tile(_t))
+        else:
+            _exe = ThreadPoolExecutor if _pool == 'thread' else ProcessPoolExecutor
+            with _exe(_workers) as _ex:
+                # Bounded number of tiles in flight
+                _pending = deque()
+                for _t in _tasks:
+                    _pending.append(_ex.submit(_weiner_tile, _t))
+                    if len(_pending) >= 2*_workers:
+                        _add(_pending.popleft().result())
+                while _pending:
+                    _add(_pending.popleft().result())
+        _out /= (_wsum[:, :, None] if _img.ndim == 3 else _wsum)
+        return _out
+    except:
+        trace()
 
 # Weiner Filtering... I
 # param _img : noisy/blurry image
@@ -18,8 +187,6 @@ from denoising import total_variation_norm
 # param _BW : whether the image is black and white
 def weiner_(_img: np.ndarray, _h: np.ndarray, SNR: float = 0.00000001, _BW: bool = True):
     try:
-        # Getting the optimal DFT size
-        __shp = _img.shape[:2]
         '''
         Getting fourier transforms (all needed)
         Sensing
@@ -30,24 +197,46 @@ def weiner_(_img: np.ndarray, _h: np.ndarray, SNR: float = 0.00000001, _BW: bool
         where K can be either of |N(u,v)|/|F(u,v)| or |N|/|F| (over complete matrix)
         & recovered image  GH*
         '''
+        # Colored (BGR) images are deblurred as one stack of channels
+        return weiner_stack(_img, _h, SNR)
+    except:
+        trace()
 
-        # If the image is colored (BGR)
-        if not _BW:
-            __temp = np.zeros(_img.shape)
-            for _i in [0,1,2]:
-                __temp[:,:,_i] = weiner_(_img[:,:,_i], _h, SNR, True)
-            return __temp
-        # else
-        H = FFT(_h, __shp)
-        G = FFT(_img, __shp)
-        K = SNR
-        # Getting the inverse filter
-        H_w = (np.conj(H)) * (1/(abs(H)**2 + K))
-        # Getting the image back...
-        F_rec = G * H_w
-        # Coming back to spatial domain
-        f_rec = np.real(IFFT(F_rec))
-        return np.fft.fftshift(f_rec)
+# Weiner Filtering for an array of K values, sharing G and H over all of them
+# Candidates are restored in batches of _batch (bounding the memory)
+# param _img : noisy/blurry image
+# param _h : estimate of the PSF
+# param _Ks : values of K to try
+# param _ref : original image, to score the candidates against (optional)
+# param _metric : 'PSNR', 'SSIM', 'MSSSIM' (batches scored at once) or a score (higher is better) _metric(_ref, _cand)
+# return : stack of restorations (one per K), or with _ref the triplet (best, K, scores)
+def weiner_sweep(_img: np.ndarray, _h: np.ndarray, _Ks: np.ndarray, _ref: np.ndarray = None, _metric = 'PSNR', _batch: int = 8):
+    try:
+        __shp = _img.shape[:2]
+        _Ks = np.asarray(_Ks, dtype=np.float64)
+        # Shared spectra
+        H = expand(psf_spectrum(_h, __shp), _img.ndim)
+        H_c, H_2 = np.conj(H), abs(H)**2
+        G = RFFT(_img, __shp)*H_c
+        # Outputs
+        _stk = np.empty((len(_Ks),) + _img.shape) if _ref is None else None
+        _scores = np.empty(len(_Ks))
+        _best = None
+        for _i in range(0, len(_Ks), _batch):
+            K = _Ks[_i:_i+_batch].reshape((-1,) + (1,)*_img.ndim)
+            # Batch of restorations
+            _f = IRFFT(G / (H_2 + K), __shp, (1, 2))
+            if _ref is None:
+                _stk[_i:_i+len(_f)] = _f
+                continue
+            # Scoring (the whole batch)
+            _scores[_i:_i+len(_f)] = score_stack(_ref, _f, _metric)
+            _j = int(np.argmax(_scores[_i:_i+len(_f)]))
+            if _best is None or _scores[_i+_j] > _scores[_best]:
+                _best, _bimg = _i+_j, _f[_j].copy()
+        if _ref is None:
+            return _stk
+        return _bimg, _Ks[_best], _scores
     except:
         trace()
 
@@ -56,11 +245,11 @@ def weiner_(_img: np.ndarray, _h: np.ndarray, SNR: float = 0.00000001, _BW: bool
 # param f_ : estimate of original image (should be the same dim as _img)
 # param _h : estimate of deblurring function (PSF)
 # param _noise : estimate of noise distribution
-# param _BW : whether the image is black and white
+# param _BW : whether the image is black and white (colored ones are one stack)
 def weiner(_img: np.ndarray, _h: np.ndarray, _noise: np.ndarray, f_: np.ndarray, _BW: bool = True):
     try:
-        _h /= _h.sum()
-        # Getting the optimal DFT size
+        _h = _h / _h.sum()
+        # Getting the DFT size
         __shp = _img.shape[:2]
         '''
         Getting fourier transforms (all needed)
@@ -72,34 +261,89 @@ def weiner(_img: np.ndarray, _h: np.ndarray, _noise: np.ndarray, f_: np.ndarray,
         where K can be either of |N(u,v)|/|F(u,v)| or |N|/|F| (over complete matrix)
         & recovered image  GH*
         '''
-
-        # If the image is colored (BGR)
-        if not _BW:
-            __temp = np.zeros(_img.shape)
-            for _i in [0,1,2]:
-                __temp[:,:,_i] = weiner_(_img[:,:,_i], _h, _noise, f_[:,:,_i], True)
-            return __temp
-        # else
-        H = FFT(_h, __shp)
-        G = FFT(_img, __shp)
-        N = FFT(_noise, __shp)
-        F_ = FFT(f_, __shp)        
+        H = expand(psf_spectrum(_h, __shp), _img.ndim)
+        G = RFFT(_img, __shp)
+        N = RFFT(_noise, __shp)
+        F_ = RFFT(f_, __shp)
         # Getting the inverse filter
         H_w = (np.conj(H)) * (1/(abs(H)**2 + ((abs(N)**2)/(abs(F_)**2))))
         # Getting the image back...
         F_rec = G * H_w
         # Coming back to spatial domain
-        f_rec = np.real(IFFT(F_rec))
-        return np.fft.fftshift(f_rec)
+        return IRFFT(F_rec, __shp)
     except:
         trace()
 
 
 
+# TV regularized deconvolution, min 0.5*|h*u - g|**2 + lam*TV(u) (isotropic)
+# Solved by ADMM on the split z = Du: every iteration is one closed-form solve in the
+# fourier domain (denominator precomputed and cached) and one pointwise shrinkage
+# (colored images are deconvolved as one stack of channels)
+# param _img : noisy/blurry image
+# param _h : estimate of the PSF
+# param _lam : weight of the TV term
+# param _rho : penalty of the split (default, _lam)
+# param _u0 : initial estimate (warm start), default the blurry image
+# param _tol : relative change of the estimate to stop at
+# param _callback : called every iteration with (iteration, estimate, relative change)
+def tv_deconvolution(_img: np.ndarray, _h: np.ndarray, _lam: float = 0.1, _rho: float = None, _u0: np.ndarray = None, _tol: float = 1e-4, _max_iter: int = 200, _callback = None):
+    try:
+        __shp = _img.shape[:2]
+        _rho = _lam if _rho is None else _rho
+        # Fixed parts of the solve
+        H = expand(psf_spectrum(_h, __shp), _img.ndim)
+        HG = np.conj(H)*RFFT(_img, __shp)
+        _den = expand(tv_denominator(_h, __shp, _rho), _img.ndim)
+        # Estimate, split variables (z = Du) and scaled multipliers
+        _u = np.array(_img if _u0 is None else _u0, dtype=np.float64)
+        _zx, _zy = _diff(_u, 1, np.empty_like(_u)), _diff(_u, 0, np.empty_like(_u))
+        _bx, _by = np.zeros_like(_u), np.zeros_like(_u)
+        _vx, _vy = np.empty_like(_u), np.empty_like(_u)
+        _t, _n = np.empty_like(_u), np.empty_like(_u)
+        for _it in range(1, _max_iter+1):
+            # Estimate, (H*H + rho D*D) u = H*g + rho D*(z - b)
+            np.subtract(_zx, _bx, out=_vx)
+            np.subtract(_zy, _by, out=_vy)
+            _diff_t(_vx, 1, _t)
+            _t += _diff_t(_vy, 0, _n)
+            _new = IRFFT((HG + _rho*RFFT(_t, __shp))/_den, __shp)
+            np.subtract(_new, _u, out=_t)
+            _chg = np.linalg.norm(_t)/max(np.linalg.norm(_new), 1e-12)
+            _u = _new
+            # Split, isotropic shrinkage of v = Du + b
+            _diff(_u, 1, _vx)
+            _vx += _bx
+            _diff(_u, 0, _vy)
+            _vy += _by
+            np.hypot(_vx, _vy, out=_n)
+            np.maximum(_n, 1e-12, out=_n)
+            np.divide(_lam/_rho, _n, out=_n)
+            np.subtract(1, _n, out=_n)
+            np.maximum(_n, 0, out=_n)
+            np.multiply(_vx, _n, out=_zx)
+            np.multiply(_vy, _n, out=_zy)
+            # Multipliers, b = v - z
+            np.subtract(_vx, _zx, out=_bx)
+            np.subtract(_vy, _zy, out=_by)
+            if _callback is not None:
+                _callback(_it, _u, _chg)
+            if _chg < _tol:
+                break
+        return _u
+    except:
+        trace()
+
 # Trying for edge preserving deblurring
-def edge_preserving_deblurring(_img: np.ndarray, _h: np.ndarray, _lam: float = 1, _BW: bool = True, __show: bool = False):
+# (colored images are deblurred as one stack of channels)
+# param _mode : 'single' (one pass, TV gradient of the blurry image) or 'ADMM' (tv_deconvolution, with _lam as the TV weight)
+def edge_preserving_deblurring(_img: np.ndarray, _h: np.ndarray, _lam: float = 1, _BW: bool = True, __show: bool = False, _mode: str = 'single', **kwargs):
     try:
-        # Getting the optimal DFT size
+        if _mode == 'ADMM':
+            return tv_deconvolution(_img, _h, _lam, **kwargs)
+        if _mode != 'single':
+            raise ValueError('Invalid mode ' + _mode)
+        # Getting the DFT size
         __shp = _img.shape[:2]
         '''
         Getting fourier transforms (all needed)
@@ -111,32 +355,163 @@ def edge_preserving_deblurring(_img: np.ndarray, _h: np.ndarray, _lam: float = 1
         where K can be either of |N(u,v)|/|F(u,v)| or |N|/|F| (over complete matrix)
         & recovered image  GH*
         '''
-
-        # If the image is colored (BGR)
-        if not _BW:
-            __temp = np.zeros(_img.shape)
-            for _i in [0,1,2]:
-                __temp[:,:,_i] = edge_preserving_deblurring(_img[:,:,_i], _h, _lam=_lam, _BW=True)
-            return __temp
-        # else
-        H = FFT(_h, __shp)
-        G = FFT(_img, __shp)
+        H = expand(psf_spectrum(_h, __shp), _img.ndim)
+        G = RFFT(_img, __shp)
         # Getting TV norm
-        _norm, _grad = total_variation_norm(_img)
+        _norm, _grad = tv_workspace(_img.shape)(_img)
         #SHOW
         if __show:
             show(_grad)
         # Getting TV FFT
-        _L = FFT(_grad, _img.shape)
+        _L = RFFT(_grad, __shp)
         #SHOW
         if __show:
             show(abs(_L)/abs(_L).max())
         # Getting the inverse filter
-        H_w = (np.conj(H)) * (1/(abs(H)**2 + _lam/abs(_L)))
+        # (abs(_L) floored, it vanishes where the image is flat)
+        H_w = (np.conj(H)) * (1/(abs(H)**2 + _lam/np.maximum(abs(_L), 1e-12)))
         # Getting the image back...
         F_rec = G * H_w
         # Coming back to spatial domain
-        f_rec = np.real(IFFT(F_rec))
-        return np.fft.fftshift(f_rec)
+        return IRFFT(F_rec, __shp)
+    except:
+        trace()
+
+
+# Iterating a (multiplicative, RL) update _step(_y, _out) from _x
+# Accelerated by vector extrapolation (Biggs-Andrews), the step along the last move
+# being the correlation of the two latest corrections. The extrapolation vectors are
+# allocated once (the step keeps its own workspaces).
+# Returns (estimate, iterations)
+def _accelerated(_step, _x, _iter, _tol, _accel, _callback=None):
+    _xp, _y = _x.copy(), _x.copy()
+    _gk, _gp = np.zeros_like(_x), None
+    _alpha = 0.
+    _it = 0
+    for _it in range(1, _iter+1):
+        # Extrapolated point (kept non negative)
+        if _accel and _alpha > 0:
+            np.subtract(_x, _xp, out=_y)
+            _y *= _alpha
+            _y += _x
+            np.maximum(_y, 0, out=_y)
+        else:
+            _y[...] = _x
+        _xp[...] = _x
+        _step(_y, _x)
+        # Step of the next extrapolation
+        if _accel:
+            np.subtract(_x, _y, out=_gk)
+            if _gp is None:
+                _gp = np.empty_like(_gk)
+            else:
+                _alpha = float(np.clip(np.vdot(_gk, _gp)/max(np.vdot(_gp, _gp), 1e-30), 0, 1))
+            _gk, _gp = _gp, _gk
+        # Relative change (_y is free)
+        np.subtract(_x, _xp, out=_y)
+        _chg = np.linalg.norm(_y)/max(np.linalg.norm(_x), 1e-12)
+        if _callback is not None:
+            _callback(_it, _x, _chg)
+        if _chg < _tol:
+            break
+    return _x, _it
+
+# Richardson-Lucy image update, y * (h' (g / (h y))), with the PSF spectrum H
+# The spectrum and the ratio live in workspaces allocated once, reused by every step
+def _image_step(_img, H):
+    __shp = _img.shape[:2]
+    H_c = np.conj(H)
+    _S = np.empty((__shp[0], __shp[1]//2+1) + _img.shape[2:], dtype=np.complex128)
+    _c = np.empty(_img.shape)
+    def _step(_y, _out):
+        # Ratio g / (h y)
+        RFFT(_y, __shp, _out=_S)
+        np.multiply(_S, H, out=_S)
+        IRFFT(_S, __shp, _out=_c)
+        np.maximum(_c, 1e-12, out=_c)
+        np.divide(_img, _c, out=_c)
+        # Correlated with h
+        RFFT(_c, __shp, _out=_S)
+        np.multiply(_S, H_c, out=_S)
+        IRFFT(_S, __shp, _out=_c)
+        np.multiply(_y, _c, out=_out)
+    return _step
+
+# Richardson-Lucy deconvolution (accelerated)
+# (colored images are deconvolved as one stack of channels, in batched transforms)
+# param _img : noisy/blurry image (non negative)
+# param _h : estimate of the PSF
+# param _iter : iteration limit (noise is amplified as iterations go on)
+# param _tol : relative change of the estimate to stop at
+# param _accel : Biggs-Andrews acceleration
+# param _u0 : initial estimate (warm start), default the blurry image
+# param _callback : called every iteration with (iteration, estimate, relative change)
+def richardson_lucy(_img: np.ndarray, _h: np.ndarray, _iter: int = 50, _tol: float = 1e-4, _accel: bool = True, _u0: np.ndarray = None, _callback = None):
+    try:
+        _h = _h / _h.sum()
+        _img = np.maximum(np.asarray(_img, dtype=np.float64), 0)
+        H = expand(psf_spectrum(_h, _img.shape[:2]), _img.ndim)
+        _x = np.array(_img if _u0 is None else np.maximum(_u0, 0), dtype=np.float64)
+        return _accelerated(_image_step(_img, H), _x, _iter, _tol, _accel, _callback)[0]
+    except:
+        trace()
+
+# PSF update (RL, image fixed) restricted to the support of _h
+def _psf_step(_img, _x, _h):
+    __shp = _img.shape[:2]
+    H = expand(OTF(_h, __shp), _img.ndim)
+    X = RFFT(_x, __shp)
+    _c = IRFFT(X*H, __shp)
+    np.maximum(_c, 1e-12, out=_c)
+    np.divide(_img, _c, out=_c)
+    # Correlation of the estimate and the ratio, at the shifts of the support
+    _cor = IRFFT(np.conj(X)*RFFT(_c, __shp), __shp)
+    if _cor.ndim > 2:
+        _cor = _cor.reshape(__shp + (-1,)).sum(axis=2)
+    _r = (np.arange(_h.shape[0]) - _h.shape[0]//2) % __shp[0]
+    _c = (np.arange(_h.shape[1]) - _h.shape[1]//2) % __shp[1]
+    _h = _h*np.maximum(_cor[np.ix_(_r, _c)], 0)
+    return _h/max(_h.sum(), 1e-12)
+
+# Blind Richardson-Lucy deconvolution, image and PSF both estimated
+# Image and PSF updates alternate on a pyramid (halving the image), from the coarsest
+# level to the finest, each level starting from the upsampled estimates of the previous
+# one, so most iterations run on small images
+# param _img : noisy/blurry image (non negative)
+# param _ksize : side of the PSF support (odd)
+# param _h0 : initial PSF (default, gaussian of std _ksize/6)
+# param _levels : levels of the pyramid
+# param _outer : alternations per level
+# param _iter : image (and PSF) iterations per alternation
+# return : pair (image, PSF)
+def blind_richardson_lucy(_img: np.ndarray, _ksize: int = 9, _h0: np.ndarray = None, _levels: int = 3, _outer: int = 10, _iter: int = 5, _tol: float = 1e-4, _accel: bool = True):
+    try:
+        _img = np.maximum(np.asarray(_img, dtype=np.float64), 0)
+        if _h0 is None:
+            _h0 = cv.getGaussianKernel(_ksize, _ksize/6)
+            _h0 = _h0 @ _h0.T
+        _h0 = np.asarray(_h0, dtype=np.float64)
+        # Pyramid of the blurry image (finest first)
+        _pyr = [_img]
+        for _ in range(1, _levels):
+            if min(_pyr[-1].shape[:2]) < 32:
+                break
+            _pyr.append(cv.pyrDown(_pyr[-1]))
+        _x = None
+        for _l in range(len(_pyr)-1, -1, -1):
+            _g = _pyr[_l]
+            # PSF support at this level (odd, at least 3)
+            _k = max(3, (_h0.shape[0] >> _l) | 1)
+            _h = cv.resize(_h0 if _x is None else _h, (_k, _k), interpolation=cv.INTER_LINEAR)
+            _h = np.maximum(_h, 0)
+            _h /= _h.sum()
+            _x = _g.copy() if _x is None else np.maximum(cv.resize(_x, _g.shape[1::-1], interpolation=cv.INTER_LINEAR), 0)
+            for _ in range(_outer):
+                # PSF, image fixed
+                _h = _accelerated(lambda _y, _out: np.copyto(_out, _psf_step(_g, _x, _y)), _h, _iter, _tol, _accel)[0]
+                # Image, PSF fixed
+                H = expand(OTF(_h, _g.shape[:2]), _g.ndim)
+                _x = _accelerated(_image_step(_g, H), _x, _iter, _tol, _accel)[0]
+        return _x, _h
     except:
         trace()
@@ -6,54 +6,75 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mio import read, write, trace, show
 from noising import add_noise
-from blurring import blur
+from metric import calculate_psnr
+from concurrent.futures import ThreadPoolExecutor
 
 __eps = np.finfo(np.float32).eps
 
-# Calculating noisy image PSNR
-# @param _img : original image (without noise)
-# @param _nimg : noisy image
-def calculate_psnr(_img: np.array, _nimg: np.array):
-    try:
-        # Converting to float
-        _img = np.array(_img, dtype=np.float)
-        _nimg = np.array(_nimg, dtype=np.float)
-        # Calculating MSE
-        _sqdiff = (_img-_nimg)**2
-        _mse = _sqdiff.sum()/_sqdiff.size
-        # Calculating PSNR (dB)
-        _psnr = 10*np.log(255*255/_mse)
-        return _psnr
-    except:
-        trace()
+# Filtering the image at any window size, sharing the work between the sizes
+# Mean : one summed-area table, every size is then O(pixels)
+# Median : OpenCV's median (sliding histograms for the larger windows)
+# Gaussian : OpenCV's separable filter
+# Borders are reflected and results rounded to 8 bits, as in blur
+# @param _nimg : noisy image (uint8)
+# @param _tp : type of filter (in sync with blur)
+# @param _smax : largest size that will be asked for
+# @return function of the (odd) size
+def sweep_filter(_nimg: np.array, _tp: str = 'ME', _smax: int = 49):
+    _h, _w = _nimg.shape[:2]
+    _r = _smax//2
+    # Mean
+    if _tp == 'ME':
+        _sat = cv.integral(cv.copyMakeBorder(_nimg, _r, _r, _r, _r, cv.BORDER_REFLECT_101), sdepth=cv.CV_64F)
+        def _filter(_sz):
+            _a, _b = _r-_sz//2, _r+_sz//2+1
+            _sum = _sat[_b:_b+_h, _b:_b+_w] - _sat[_a:_a+_h, _b:_b+_w] - _sat[_b:_b+_h, _a:_a+_w] + _sat[_a:_a+_h, _a:_a+_w]
+            return np.uint8(np.clip(np.rint(_sum/(_sz*_sz)), 0, 255))
+        return _filter
+    # Median
+    if _tp == 'MD':
+        return lambda _sz: cv.medianBlur(_nimg, _sz)
+    # Gaussian (separable, cheaper than a shared spectrum at these sizes)
+    if _tp == 'GS':
+        return lambda _sz: cv.GaussianBlur(_nimg, (_sz, _sz), 0)
+    raise ValueError('Invalid filter type ' + _tp)
 
 # Finding the image with highest PSNR and respective filter size
+# Sizes are evaluated in parallel, in waves of _workers (in increasing order)
 # @param _img : original image
 # @param _nimg : noisy image
 # @param _tp : type of filter (in sync with blur)
-def find_best_size(_img: np.array, _nimg: np.array, _tp: str = 'ME', _plt: bool = False):
+# @param _workers : number of sizes evaluated together
+# @param _stop : stop once PSNR falls this many dB below the best (None, never)
+def find_best_size(_img: np.array, _nimg: np.array, _tp: str = 'ME', _plt: bool = False, _workers: int = 4, _stop: float = None):
     try:
         # Setting default as best
         _bst = _nimg
         _psnr = calculate_psnr(_bst, _img)
         _fsz = 1
-        # If plot is to be shown
-        if _plt:
-            _szl = []
-            _psnrl = []
+        # Sizes (and their PSNR)
+        _sizes = list(range(3, 50, 2))
+        _szl = []
+        _psnrl = []
+        _filter = sweep_filter(_nimg, _tp, _sizes[-1])
+        # One size
+        def _eval(_sz):
+            _bimg = _filter(_sz)
+            return _sz, _bimg, calculate_psnr(_bimg, _img)
         # Looping over sizes
-        for _sz in range(3, 50, 2):
-            _bimg = blur(_nimg, _sz, _tp)
-            _psnri = calculate_psnr(_bimg, _img)
-            # Plotting
-            if _plt:
-                _szl.append(_sz)
-                _psnrl.append(_psnri)
-            # Better found
-            if _psnri > _psnr:
-                _bst = _bimg
-                _fsz = _sz
-                _psnr = _psnri
+        with ThreadPoolExecutor(_workers) as pool:
+            for _i in range(0, len(_sizes), _workers):
+                for _sz, _bimg, _psnri in pool.map(_eval, _sizes[_i:_i+_workers]):
+                    _szl.append(_sz)
+                    _psnrl.append(_psnri)
+                    # Better found
+                    if _psnri > _psnr:
+                        _bst = _bimg
+                        _fsz = _sz
+                        _psnr = _psnri
+                # Peak clearly passed
+                if _stop is not None and _psnrl[-1] < _psnr - _stop:
+                    break
         # Showing plot
         if _plt:
             plt.plot(_szl, _psnrl)
@@ -85,37 +106,171 @@ def total_variation_norm(_img: np.ndarray):
     return _norm, _grad
 
 
-def tv_denoise(_img: np.ndarray, _lmbda: float = 0.001):
+# Periodic differences _u - roll(_u, -1, _axis), by slicing into _out
+def _diff(_u: np.ndarray, _axis: int, _out: np.ndarray):
+    _a, _o = np.moveaxis(_u, _axis, 0), np.moveaxis(_out, _axis, 0)
+    np.subtract(_a[:-1], _a[1:], out=_o[:-1])
+    np.subtract(_a[-1], _a[0], out=_o[-1])
+    return _out
+
+
+# Adjoint of _diff, _p - roll(_p, 1, _axis), by slicing into _out
+def _diff_t(_p: np.ndarray, _axis: int, _out: np.ndarray):
+    _a, _o = np.moveaxis(_p, _axis, 0), np.moveaxis(_out, _axis, 0)
+    np.subtract(_a[1:], _a[:-1], out=_o[1:])
+    np.subtract(_a[0], _a[-1], out=_o[0])
+    return _out
+
+
+# Workspace for total_variation_norm, on images of shape _shp
+# Differences, magnitude and gradient live in preallocated buffers, so calls
+# allocate nothing. Results are the same as total_variation_norm (on float images).
+# @return function of the image giving (_norm, _grad), _grad being overwritten by the next call
+def tv_workspace(_shp: tuple, _dtype=np.float64):
+    _Dx = np.empty(_shp, dtype=_dtype)
+    _Dy = np.empty(_shp, dtype=_dtype)
+    _gradn = np.empty(_shp, dtype=_dtype)
+    _grad = np.empty(_shp, dtype=_dtype)
+    def _tv(_img: np.ndarray):
+        # Derivatives along x and y axis
+        _diff(_img, 1, _Dx)
+        _diff(_img, 0, _Dy)
+        # L2 norm of the gradient
+        np.multiply(_Dx, _Dx, out=_gradn)
+        np.multiply(_Dy, _Dy, out=_grad)
+        np.add(_gradn, _grad, out=_gradn)
+        np.add(_gradn, __eps, out=_gradn)
+        np.sqrt(_gradn, out=_gradn)
+        _norm = _gradn.sum()
+        # Scaling (2*0.5/_gradn)
+        np.reciprocal(_gradn, out=_gradn)
+        np.multiply(_Dx, _gradn, out=_Dx)
+        np.multiply(_Dy, _gradn, out=_Dy)
+        # Gradient
+        np.add(_Dx, _Dy, out=_grad)
+        np.subtract(_grad[:,1:], _Dx[:,:-1], out=_grad[:,1:])
+        np.subtract(_grad[1:], _Dy[:-1], out=_grad[1:])
+        return _norm, _grad
+    return _tv
+
+
+# Total variation energy (TV norm plus the weighted L2 distance to _org)
+def tv_energy(_img: np.ndarray, _org: np.ndarray, _lmbda: float = 0.001):
+    return total_variation_norm(_img)[0] + _lmbda*((_img - _org)**2).sum()
+
+
+# Solving min TV(u) + lmbda*|u - f|^2 with the accelerated primal-dual algorithm
+# (Chambolle-Pock, the L2 term being uniformly convex), periodic differences as in
+# total_variation_norm. Stops once the relative change of the image is below _tol.
+def _tv_primal_dual(_org: np.ndarray, _lmbda: float, _tol: float, _max_iter: int, _callback=None):
+    _u = _org.copy()
+    _ub = _org.copy()
+    _px = np.zeros_like(_org)
+    _py = np.zeros_like(_org)
+    _gx = np.empty_like(_org)
+    _gy = np.empty_like(_org)
+    _div = np.empty_like(_org)
+    _n = np.empty_like(_org)
+    # Steps (tau*sigma*|D|^2 = 1, |D|^2 = 8)
+    _tau = 0.25/_lmbda**0.5
+    _sig = 1/(8*_tau)
+    for _it in range(1, _max_iter+1):
+        # Dual ascent, differences of the extrapolated image
+        _diff(_ub, 1, _gx)
+        _diff(_ub, 0, _gy)
+        _gx *= _sig
+        _gy *= _sig
+        _px += _gx
+        _py += _gy
+        # Projection on the unit ball (per pixel)
+        np.multiply(_px, _px, out=_n)
+        np.multiply(_py, _py, out=_div)
+        _n += _div
+        np.sqrt(_n, out=_n)
+        np.maximum(_n, 1, out=_n)
+        _px /= _n
+        _py /= _n
+        # Primal descent (adjoint of the differences) and the L2 proximal step
+        _diff_t(_px, 1, _div)
+        _div += _diff_t(_py, 0, _gx)
+        _ub[...] = _u
+        _div *= _tau
+        _u -= _div
+        _u += np.multiply(_org, 2*_tau*_lmbda, out=_gy)
+        _u /= 1 + 2*_tau*_lmbda
+        # Acceleration
+        _th = 1/(1 + 4*_lmbda*_tau)**0.5
+        _tau *= _th
+        _sig /= _th
+        # Relative change, and extrapolation (_ub holding the previous image)
+        _ub -= _u
+        _chg = np.linalg.norm(_ub)/max(np.linalg.norm(_u), __eps)
+        _ub *= -_th
+        _ub += _u
+        if _callback is not None:
+            _callback(_it, _u, _chg)
+        if _chg < _tol:
+            break
+    return _u
+
+
+# Total variation denoising
+# @param _img : noisy image
+# @param _lmbda : weight of the L2 (fidelity) term
+# @param _method : 'GD' (gradient descent, until the loss goes up) or 'CP' (accelerated primal-dual)
+# @param _tol : relative change of the image to stop at (CP)
+# @param _max_iter : iteration limit (None, unbounded for GD and 1000 for CP)
+# @param _dtype : working type (None, float64 for CP and as given for GD)
+# @param _callback : called every iteration with (iteration, image, loss for GD or relative change for CP)
+def tv_denoise(_img: np.ndarray, _lmbda: float = 0.001, _method: str = 'GD', _tol: float = 1e-4, _max_iter: int = None, _dtype=None, _callback=None):
+    if _dtype is not None:
+        _img = np.asarray(_img, dtype=_dtype)
+    if _method == 'CP':
+        return _tv_primal_dual(np.array(_img, dtype=_dtype or np.float64), _lmbda, _tol, _max_iter or 1000, _callback)
+    if _method != 'GD':
+        raise ValueError('Invalid method ' + _method)
+
     # Setting up
-    # Keeping the original image copy
+    # Working copy (float) and the original image copy
+    _img = np.array(_img, dtype=_img.dtype if np.issubdtype(_img.dtype, np.floating) else np.float64)
     _org = _img.copy()
+    _tv = tv_workspace(_img.shape, _img.dtype)
+    _L2_grad = np.empty_like(_img)
+    _sq = np.empty_like(_img)
 
-    # Function working as our image iterator
+    # Function working as our image iterator (in place)
     def next_(_img: np.ndarray, _grad: np.ndarray, _step: float = 0.001):
-        return _img - _grad*_step
+        _grad *= _step
+        _img -= _grad
+        return _img
     
     # Function working as evaluator
     def eval_(_img: np.ndarray):
         # Total variation parameters
-        _TV_loss, _TV_grad = total_variation_norm(_img)
+        _TV_loss, _TV_grad = _tv(_img)
         # Absolute (L2) parameters
-        _L2_grad = _img - _org
-        _L2_loss = (_L2_grad**2).sum()
+        np.subtract(_img, _org, out=_L2_grad)
+        _L2_loss = np.multiply(_L2_grad, _L2_grad, out=_sq).sum()
         # Total _grad and _loss
-        _grad = _TV_grad + _lmbda*_L2_grad
+        np.multiply(_L2_grad, _lmbda, out=_L2_grad)
+        _TV_grad += _L2_grad
         _loss = _TV_loss + _lmbda*_L2_loss
         # Return
-        return _loss, _grad
+        return _loss, _TV_grad
 
     # Loop parameters
     loop_loss = np.inf
+    _it = 0
     # Main loop
-    while True:
+    while _max_iter is None or _it < _max_iter:
         _loss, _grad = eval_(_img)
         if _loss > loop_loss:
             break
         loop_loss = _loss
         _img = next_(_img, _grad)
+        _it += 1
+        if _callback is not None:
+            _callback(_it, _img, _loss)
     
     # Returning the final created image
     return _img
\ No newline at end of file
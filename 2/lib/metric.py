@@ -0,0 +1,174 @@
+# Library for image quality metrics (PSNR, SSIM, MS-SSIM)
+# Images are (h, w) or (h, w, channels), stacks of candidates have one more
+# (leading) axis and are scored against one reference in a single call.
+
+import cv2 as cv
+import numpy as np
+
+from mio import trace
+
+# Rows per tile when accumulating squared differences
+_tile = 256
+
+# SSIM constants, and the MS-SSIM weights (finest scale first)
+_K1 = 0.01
+_K2 = 0.03
+_ms_weights = np.array([0.0448, 0.2856, 0.3001, 0.2363, 0.1333])
+
+
+# Data range of an image (its integer type, 255 otherwise)
+def _data_range(_img: np.array):
+    if np.issubdtype(_img.dtype, np.integer):
+        _info = np.iinfo(_img.dtype)
+        return _info.max - _info.min
+    return 255
+
+
+# Sums of squared differences of a stack (n, ...) against _img, tile by tile
+def _sq_sums(_img: np.array, _stk: np.array):
+    _sums = np.zeros(len(_stk))
+    for _r in range(0, _img.shape[0], _tile):
+        _d = np.subtract(_stk[:, _r:_r+_tile], _img[_r:_r+_tile], dtype=np.float64)
+        _d = _d.reshape(len(_stk), -1)
+        _sums += np.einsum('ij,ij->i', _d, _d)
+    return _sums
+
+
+# PSNR (dB) of every candidate of a stack against _img
+# @param _img : original image (without noise)
+# @param _stk : stack of candidates (n, ...)
+# @param _range : data range (None, from the type of _img)
+def psnr_stack(_img: np.array, _stk: np.array, _range: float = None):
+    _range = _data_range(_img) if _range is None else _range
+    _mse = _sq_sums(_img, _stk)/_img.size
+    with np.errstate(divide='ignore'):
+        return 10*np.log10(_range*_range/_mse)
+
+
+# Calculating noisy image PSNR
+# @param _img : original image (without noise)
+# @param _nimg : noisy image
+# @param _range : data range (None, from the type of _img)
+def calculate_psnr(_img: np.array, _nimg: np.array, _range: float = None):
+    try:
+        return psnr_stack(_img, np.asarray(_nimg)[None], _range)[0]
+    except:
+        trace()
+
+
+# Local mean filter (box of _win, or gaussian of sigma 1.5 on 11x11), reflected border
+def _filter(_win: int, _gaussian: bool):
+    if _gaussian:
+        return lambda _x: cv.GaussianBlur(_x, (11, 11), 1.5, borderType=cv.BORDER_REFLECT)
+    return lambda _x: cv.boxFilter(_x, -1, (_win, _win), borderType=cv.BORDER_REFLECT)
+
+
+# SSIM (and contrast-structure) of a stack (n, ...) against _img, as means over the
+# valid part (the border of half a window is left out)
+def _ssim_stack(_img: np.array, _stk: np.array, _range: float, _win: int, _gaussian: bool):
+    _win = 11 if _gaussian else _win
+    _f = _filter(_win, _gaussian)
+    _np = _win*_win
+    # Sample covariance, as skimage (compare_ssim) does on the box window
+    _cov = 1 if _gaussian else _np/(_np-1)
+    _C1, _C2 = (_K1*_range)**2, (_K2*_range)**2
+    _p = (_win-1)//2
+    # Statistics of the reference, shared by all candidates
+    _X = np.asarray(_img, dtype=np.float64)
+    _ux = _f(_X)
+    _vx = _cov*(_f(_X*_X) - _ux*_ux)
+    _ssim, _cs = np.empty(len(_stk)), np.empty(len(_stk))
+    for _i, _y in enumerate(_stk):
+        _Y = np.asarray(_y, dtype=np.float64)
+        _uy = _f(_Y)
+        _vy = _cov*(_f(_Y*_Y) - _uy*_uy)
+        _vxy = _cov*(_f(_X*_Y) - _ux*_uy)
+        _CS = (2*_vxy + _C2)/(_vx + _vy + _C2)
+        _S = _CS*(2*_ux*_uy + _C1)/(_ux*_ux + _uy*_uy + _C1)
+        _cs[_i] = _CS[_p:-_p, _p:-_p].mean()
+        _ssim[_i] = _S[_p:-_p, _p:-_p].mean()
+    return _ssim, _cs
+
+
+# SSIM of every candidate of a stack against _img (channels are averaged)
+# @param _img : original image (without noise)
+# @param _stk : stack of candidates (n, ...)
+# @param _range : data range (None, from the type of _img)
+# @param _win : side of the box window
+# @param _gaussian : gaussian window (sigma 1.5, 11x11) instead of the box
+def ssim_stack(_img: np.array, _stk: np.array, _range: float = None, _win: int = 7, _gaussian: bool = False):
+    _range = _data_range(_img) if _range is None else _range
+    return _ssim_stack(_img, _stk, _range, _win, _gaussian)[0]
+
+
+# Calculate the SSIM b/w two images
+# Box window of 7 and sample covariance by default, as skimage's compare_ssim
+# @param _img : original image (without noise)
+# @param _nimg : noisy image
+def calculate_ssim(_img: np.array, _nimg: np.array, _range: float = None, _win: int = 7, _gaussian: bool = False):
+    try:
+        return ssim_stack(_img, np.asarray(_nimg)[None], _range, _win, _gaussian)[0]
+    except:
+        trace()
+
+
+# Halving an image (or a stack, with _axis=1) by averaging 2x2 blocks
+def _halve(_img: np.array, _axis: int = 0):
+    _h, _w = _img.shape[_axis]//2*2, _img.shape[_axis+1]//2*2
+    _img = _img[(slice(None),)*_axis + (slice(0, _h), slice(0, _w))]
+    _shp = _img.shape[:_axis] + (_h//2, 2, _w//2, 2) + _img.shape[_axis+2:]
+    return _img.reshape(_shp).mean(axis=(_axis+1, _axis+3))
+
+
+# Multi-scale SSIM of every candidate of a stack against _img
+# Contrast-structure of the finer scales and the SSIM of the coarsest one, weighted
+# @param _img : original image (without noise)
+# @param _stk : stack of candidates (n, ...)
+# @param _weights : weights of the scales (finest first)
+def msssim_stack(_img: np.array, _stk: np.array, _range: float = None, _win: int = 7, _gaussian: bool = False, _weights: np.array = _ms_weights):
+    _range = _data_range(_img) if _range is None else _range
+    _side = 11 if _gaussian else _win
+    if min(_img.shape[:2]) < _side*2**(len(_weights)-1):
+        raise ValueError('Image too small for ' + str(len(_weights)) + ' scales')
+    _X = np.asarray(_img, dtype=np.float64)
+    _Y = np.asarray(_stk, dtype=np.float64)
+    _ms = np.ones(len(_stk))
+    for _j, _w in enumerate(_weights):
+        _ssim, _cs = _ssim_stack(_X, _Y, _range, _win, _gaussian)
+        if _j == len(_weights)-1:
+            _ms *= np.maximum(_ssim, 0)**_w
+        else:
+            _ms *= np.maximum(_cs, 0)**_w
+            _X, _Y = _halve(_X), _halve(_Y, 1)
+    return _ms
+
+
+# Calculate the MS-SSIM b/w two images
+# @param _img : original image (without noise)
+# @param _nimg : noisy image
+def calculate_msssim(_img: np.array, _nimg: np.array, _range: float = None, _win: int = 7, _gaussian: bool = False):
+    try:
+        return msssim_stack(_img, np.asarray(_nimg)[None], _range, _win, _gaussian)[0]
+    except:
+        trace()
+
+
+# Metrics by name, as functions of (reference, stack)
+_metrics = {
+    'PSNR': psnr_stack,
+    'SSIM': ssim_stack,
+    'MSSSIM': msssim_stack,
+}
+
+
+# Scoring a stack of candidates against one reference
+# @param _img : original image (without noise)
+# @param _stk : stack of candidates (n, ...)
+# @param _metric : 'PSNR', 'SSIM', 'MSSSIM' or a function _metric(_img, _cand)
+# @return array of the scores (higher is better)
+def score_stack(_img: np.array, _stk: np.array, _metric='PSNR', **kwargs):
+    if callable(_metric):
+        return np.array([_metric(_img, _c) for _c in _stk], dtype=np.float64)
+    if _metric not in _metrics:
+        raise ValueError('Invalid metric ' + str(_metric))
+    return _metrics[_metric](_img, _stk, **kwargs)
@@ -3,49 +3,114 @@
 import sys
 import cv2 as cv
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from mio import write, read, trace
 
+# Rows of noise generated at a time (the only extra memory, in float32)
+_chunk = 256
+
+
+# Generator from a seed (a Generator is used as is)
+def generator(_seed=None) -> np.random.Generator:
+    return _seed if isinstance(_seed, np.random.Generator) else np.random.default_rng(_seed)
+
+
+# Independent substreams of a seed (one per worker, image...)
+# @param _seed : int, SeedSequence or None (fresh entropy)
+# @param _n : number of streams
+def substreams(_seed, _n: int) -> list:
+    _ss = _seed if isinstance(_seed, np.random.SeedSequence) else np.random.SeedSequence(_seed)
+    return [np.random.default_rng(_s) for _s in _ss.spawn(_n)]
+
 
 # Function to add noise to an image
+# Noise is generated a chunk of rows at a time and applied with saturation,
+# straight into the 8-bit output (which may be the image itself)
 # @param _img : original image
 # @param _type : type of the noise
-def add_noise(_img: np.array, _type: str, _rng: int = 50) -> np.array:
+# @param _rng : range (U) or standard deviation (G) of the noise
+# @param _seed : seed or Generator (None, fresh entropy)
+# @param _out : uint8 output, of the shape of the image (None, a new one)
+def add_noise(_img: np.array, _type: str, _rng: int = 50, _seed=None, _out: np.array = None) -> np.array:
     try:
-        # Salt noise
-        if _type == 'S':
-            _n_img = np.where(np.random.random(_img.shape) > 0.80, 255, _img)
-        # Pepper noise
-        elif _type == 'P':
-            _n_img = np.where(np.random.random(_img.shape) > 0.80, 0, _img)
-        # Salt and pepper noise
-        elif _type == 'SP':
-            _n_img = np.where(np.random.random(_img.shape) > 0.9, 255, _img)
-            _n_img = np.where(np.random.random(_img.shape) > 0.9, 0, _n_img)
-        # Gaussian Noise
-        elif _type == 'G':
-            _n_img = _img + np.random.normal(0, _rng, _img.shape)
-            _n_img = np.where(_n_img < 0, 0, _n_img)
-            _n_img = np.where(_n_img > 255, 255, _n_img)
-            _n_img = np.array(_n_img, dtype=np.uint8)
-        # Uniform Noise
-        elif _type == 'U':
-            _n_img = _img + np.random.uniform(-_rng/2, _rng/2, _img.shape)
-            _n_img = np.where(_n_img < 0, 0, _n_img)
-            _n_img = np.where(_n_img > 255, 255, _n_img)
-            _n_img = np.array(_n_img, dtype=np.uint8)
-        # Error (Inavlid)
-        else:
+        if _type not in ('S', 'P', 'SP', 'G', 'U'):
             raise ValueError('No available noise type ' + _type)
+        _gen = generator(_seed)
+        if _out is None:
+            _out = np.empty(_img.shape, dtype=np.uint8)
+        _buf = np.empty((min(_chunk, _img.shape[0]),) + _img.shape[1:], dtype=np.float32)
+        for _r in range(0, _img.shape[0], _chunk):
+            _src, _dst = _img[_r:_r+_chunk], _out[_r:_r+_chunk]
+            _n = _buf[:_src.shape[0]]
+            if _type in ('S', 'P', 'SP'):
+                _gen.random(dtype=np.float32, out=_n)
+                if _out is not _img:
+                    _dst[...] = _src
+                # Salt noise
+                if _type == 'S':
+                    np.copyto(_dst, 255, where=_n > 0.80)
+                # Pepper noise
+                elif _type == 'P':
+                    np.copyto(_dst, 0, where=_n > 0.80)
+                # Salt and pepper noise (salt 0.9*0.1, pepper 0.1, from one field)
+                else:
+                    np.copyto(_dst, 0, where=_n < 0.1)
+                    np.copyto(_dst, 255, where=(_n >= 0.1) & (_n < 0.19))
+                continue
+            # Gaussian Noise
+            if _type == 'G':
+                _gen.standard_normal(dtype=np.float32, out=_n)
+                _n *= _rng
+            # Uniform Noise
+            else:
+                _gen.random(dtype=np.float32, out=_n)
+                _n -= 0.5
+                _n *= _rng
+            _n += _src
+            # Saturating (truncated, as the cast to uint8)
+            np.clip(_n, 0, 255, out=_n)
+            np.copyto(_dst, _n, casting='unsafe')
         # Return
-        return _n_img
+        return _out
     except:
         trace()
 
+
+# Adding noise to a batch of images (any iterable, consumed lazily)
+# Every image gets its own substream of _seed (in order), so the results do not
+# depend on the number of workers
+# @param _imgs : images
+# @param _workers : threads (0, in the calling thread)
+# @param _inplace : noise is applied to the (uint8) images themselves
+# @return generator of the noisy images, in order
+def add_noise_batch(_imgs, _type: str, _rng: int = 50, _seed=None, _workers: int = 0, _inplace: bool = False):
+    _ss = _seed if isinstance(_seed, np.random.SeedSequence) else np.random.SeedSequence(_seed)
+    def _one(_img, _gen):
+        return add_noise(_img, _type, _rng, _gen, _img if _inplace else None)
+    # Substreams are spawned here, in the order of the images
+    def _next_gen():
+        return substreams(_ss, 1)[0]
+    if _workers <= 0:
+        for _img in _imgs:
+            yield _one(_img, _next_gen())
+        return
+    # Bounded window of pending images
+    with ThreadPoolExecutor(_workers) as pool:
+        _pending = deque()
+        for _img in _imgs:
+            _pending.append(pool.submit(_one, _img, _next_gen()))
+            if len(_pending) >= 2*_workers:
+                yield _pending.popleft().result()
+        while _pending:
+            yield _pending.popleft().result()
+
 # Main Module
 # ARG
 # read_name : argv[1]
 # write_name : argv[1]
 # noise_type : argv[1]
+# seed : argv[5] (optional)
 if __name__ == "__main__":
     try:
         # Read Name
@@ -59,7 +124,12 @@ if __name__ == "__main__":
             _rng = int(sys.argv[4])
         except:
             _rng = 50
+        # Seed
+        try:
+            _seed = int(sys.argv[5])
+        except:
+            _seed = None
         # Completing the task
-        write(_wname, add_noise(read(_rname), _noise_type, _rng))
+        write(_wname, add_noise(read(_rname), _noise_type, _rng, _seed))
     except:
         trace()
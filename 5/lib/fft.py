@@ -1,28 +1,78 @@
 # Snippet for elegant FFT and IFFT using numpy (2 dimensional)
+# Transforms run on scipy.fft (multi-threaded, see set_workers) when available,
+# on numpy.fft otherwise.
 
+import os
+import threading
 import numpy as np
 import cv2 as cv
+try:
+    import scipy.fft as _fft
+except ImportError:
+    _fft = None
+
+# Threads per transform (scipy only)
+_workers = [os.cpu_count() or 1]
+# Padding buffers, per thread
+_local = threading.local()
+
+
+# Setting the number of threads per transform, returns the previous one
+def set_workers(_n: int) -> int:
+    _old = _workers[0]
+    _workers[0] = max(1, int(_n))
+    return _old
+
+# Calling a transform of the backend
+def _call(_name: str, *args, **kwargs):
+    if _fft is None:
+        return getattr(np.fft, _name)(*args, **kwargs)
+    return getattr(_fft, _name)(*args, workers=_workers[0], **kwargs)
+
+# Fast transform shape, at least _shp (each axis padded independently)
+# param _real : lengths for a real input transform
+def fast_shape(_shp: tuple, _real: bool = True) -> tuple:
+    if _fft is None:
+        return tuple(cv.getOptimalDFTSize(n) for n in _shp)
+    return tuple(_fft.next_fast_len(n, _real) for n in _shp)
+
+# Zero padding of _img to _shp (image placed at _org), into a reused buffer
+# The buffer is only valid until the next padding of the same geometry by the thread
+def _padded(_img: np.ndarray, _shp: tuple, _org: tuple) -> np.ndarray:
+    _shp = tuple(_shp[:2]) + _img.shape[2:]
+    if _shp[:2] == _img.shape[:2]:
+        return _img
+    _key = (_shp, _img.shape, _img.dtype.str, _org)
+    _bufs = getattr(_local, 'bufs', None)
+    if _bufs is None:
+        _bufs = _local.bufs = {}
+    _buf = _bufs.get(_key)
+    if _buf is None:
+        _buf = _bufs[_key] = np.zeros(_shp, dtype=_img.dtype)
+        # Keeping only the latest geometries
+        while len(_bufs) > 4:
+            del _bufs[next(iter(_bufs))]
+    _buf[_org[0]:_org[0]+_img.shape[0], _org[1]:_org[1]+_img.shape[1]] = _img
+    return _buf
 
 
 # Fast fourier transform (shifted)
 # param _img : original input image (a 2D matrix)
-# param _shp : shape tuple
-# NOTE -> _shp should be fft optimal
-def FFT(_img: np.ndarray, _shp: tuple, _shft: bool = True, _c_pad: bool = True) -> np.ndarray:
+# param _shp : shape tuple (None, the fast shape at least the image's)
+# param _shft : whether the spectrum is shifted (zero frequency at the center)
+# param _c_pad : whether the padding is centered (else at the end)
+# param _real : real input transform (half spectrum, never shifted)
+def FFT(_img: np.ndarray, _shp: tuple = None, _shft: bool = True, _c_pad: bool = True, _real: bool = False) -> np.ndarray:
+    if _shp is None:
+        _shp = fast_shape(_img.shape[:2], _real)
     _x = -_img.shape[0]+_shp[0]
     _y = -_img.shape[1]+_shp[1]
-    # Getting padding
-    _x1 = _x//2
-    _x2 = (_x+1)//2
-    _y1 = _y//2
-    _y2 = (_y+1)//2
     # Padding the image
-    if _c_pad:
-        _img_pad = cv.copyMakeBorder(_img, _x1, _x2, _y1, _y2, cv.BORDER_CONSTANT)
-    else:
-        _img_pad = cv.copyMakeBorder(_img, 0, _x, 0, _y, cv.BORDER_CONSTANT)
+    _img_pad = _padded(_img, _shp, (_x//2, _y//2) if _c_pad else (0, 0))
     # Calculating the FFT
-    _img_ft = np.fft.fft2(_img_pad)
+    if _real:
+        return _call('rfft2', _img_pad)
+    _img_ft = _call('fft2', _img_pad)
     # Transforming (if offered)
     if _shft:
         _img_ft = np.fft.fftshift(_img_ft)
@@ -32,14 +82,17 @@ def FFT(_img: np.ndarray, _shp: tuple, _shft: bool = True, _c_pad: bool = True)
 # Inverse fast fourier transform
 # param _img : original input image (a 2D matrix)
 # param _shft : whether shift is considered
-def IFFT(_img: np.ndarray, _shft: bool = True) -> np.ndarray:
+# param _shp : shape of the real output, for a half spectrum (from FFT with _real)
+def IFFT(_img: np.ndarray, _shft: bool = True, _shp: tuple = None) -> np.ndarray:
+    if _shp is not None:
+        return _call('irfft2', _img, s=_shp)
     # Transforming (if shift)
     if _shft:
         _img_ft = np.fft.ifftshift(_img)
     else:
         _img_ft = _img
     # Calculating the IFFT
-    _img_rec = np.fft.ifft2(_img_ft)
+    _img_rec = _call('ifft2', _img_ft)
     # Return
     return _img_rec
 